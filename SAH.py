@@ -7,20 +7,41 @@ Cambios aplicados:
  - Pequeños retoques estéticos (tema 'clam' si está disponible, fuente y paddings)
  - Mantengo intacta la lógica de cálculo y el simulador que indicabas.
 Requisitos: Python 3.8+, numpy, matplotlib, tkinter
+
+Uso sin interfaz (no importa tkinter ni matplotlib):
+    python SAH.py run --areas areas.csv --storm storm.csv --out result.csv
+    python SAH.py run --areas areas.csv --storm tormentas/ --out resultados/
 """
-import tkinter as tk
-from tkinter import ttk, messagebox, scrolledtext, filedialog
+import os
+import sys
 import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 
-# Intentar importar 3D
-try:
-    from mpl_toolkits.mplot3d import Axes3D  # noqa: F401
-    HAS_3D = True
-except Exception:
-    HAS_3D = False
+# tkinter y matplotlib se cargan bajo demanda (_load_plotting / _load_gui) para que
+# el núcleo numérico se pueda importar rápido y en servidores sin pantalla.
+tk = ttk = messagebox = scrolledtext = filedialog = None
+plt = FigureCanvasTkAgg = None
+HAS_3D = False
+
+def _load_plotting():
+    global plt, HAS_3D
+    if plt is not None:
+        return
+    import matplotlib.pyplot as plt
+    # Intentar importar 3D
+    try:
+        from mpl_toolkits.mplot3d import Axes3D  # noqa: F401
+        HAS_3D = True
+    except Exception:
+        HAS_3D = False
+
+def _load_gui():
+    global tk, ttk, messagebox, scrolledtext, filedialog, FigureCanvasTkAgg
+    if tk is not None:
+        return
+    import tkinter as tk
+    from tkinter import ttk, messagebox, scrolledtext, filedialog
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+    _load_plotting()
 
 def compute_Y_from_hour_vectors(Ce_vec, Cm_vec, a):
     Ce = np.asarray(Ce_vec, dtype=float).reshape(-1)
@@ -64,10 +85,1773 @@ def compute_W_from_V(V):
             W[k] += V[i, j]
     return W
 
+# --------------------------
+# Motor de W por convolución
+# --------------------------
+# V_{i,j} = A_i * q_j con q_j = P_j * Ce_j * Cm_j, así que sumar las antidiagonales
+# de V equivale a W = A * q (convolución 1-D). compute_W_from_V queda como referencia.
+W_ENGINES = ("auto", "loop", "direct", "fft")
+# por debajo de este tamaño (vector más corto) np.convolve gana a la FFT
+W_DIRECT_MAX_KERNEL = 128
+
+def compute_effective_depth(P_mm, Ce_vec, Cm_vec, units_mm=True):
+    P = np.asarray(P_mm, dtype=float).reshape(-1)
+    Ce = np.asarray(Ce_vec, dtype=float).reshape(-1)
+    Cm = np.asarray(Cm_vec, dtype=float).reshape(-1)
+    if Ce.size != Cm.size:
+        raise ValueError("Ce y Cm deben tener igual longitud (p).")
+    if P.size != Ce.size:
+        raise ValueError("Longitud de P debe ser igual número de columnas de Y (p).")
+    if units_mm:
+        P = P / 1000.0
+    return P * Ce * Cm
+
+def _next_pow2(n):
+    return 1 << max(int(n) - 1, 0).bit_length()
+
+def _W_loop(A, q):
+    return compute_W_from_V(np.outer(A, q))
+
+def _W_direct(A, q):
+    return np.convolve(A, q)
+
+def _W_fft(A, q):
+    # overlap-add: el vector largo se corta en bloques de L muestras y cada bloque
+    # se convoluciona con el corto en un único rfft/irfft vectorizado
+    x, k = (A, q) if A.size >= q.size else (q, A)
+    n, m = x.size, k.size
+    h = n + m - 1
+    nfft = _next_pow2(h)
+    if nfft > 8 * _next_pow2(2 * m):
+        nfft = 8 * _next_pow2(2 * m)
+    L = nfft - m + 1
+    if L >= n:
+        nfft = _next_pow2(h)
+        return np.fft.irfft(np.fft.rfft(x, nfft) * np.fft.rfft(k, nfft), nfft)[:h]
+    nb = -(-n // L)
+    blocks = np.zeros((nb, L))
+    blocks.reshape(-1)[:n] = x
+    y = np.fft.irfft(np.fft.rfft(blocks, nfft, axis=1) * np.fft.rfft(k, nfft), nfft, axis=1)
+    out = np.zeros((nb + 1) * L)
+    out[:nb * L] = y[:, :L].reshape(-1)
+    # colas de cada bloque (m-1 <= L muestras) sobre el inicio del siguiente
+    tails = np.zeros((nb, L))
+    tails[:, :m - 1] = y[:, L:L + m - 1]
+    out[L:] += tails.reshape(-1)
+    return out[:h]
+
+def select_W_engine(a, p):
+    if min(a, p) <= W_DIRECT_MAX_KERNEL:
+        return "direct"
+    return "fft"
+
+def compute_W(A_m2, q_eff, engine="auto"):
+    A = np.asarray(A_m2, dtype=float).reshape(-1)
+    q = np.asarray(q_eff, dtype=float).reshape(-1)
+    if A.size == 0 or q.size == 0:
+        raise ValueError("Se necesita al menos un área y una precipitación.")
+    if engine == "auto":
+        engine = select_W_engine(A.size, q.size)
+    if engine == "loop":
+        return _W_loop(A, q)
+    if engine == "direct":
+        return _W_direct(A, q)
+    if engine == "fft":
+        return _W_fft(A, q)
+    raise ValueError(f"Motor de W desconocido: {engine!r} (opciones: {', '.join(W_ENGINES)}).")
+
+# --------------------------
+# V factorizada (rango 1)
+# --------------------------
+class FactoredV:
+    # V = A ⊗ q guardada como dos vectores; las celdas sólo se generan si se piden
+    __slots__ = ("A", "q")
+
+    def __init__(self, A_m2, q_eff):
+        self.A = np.asarray(A_m2, dtype=float).reshape(-1)
+        self.q = np.asarray(q_eff, dtype=float).reshape(-1)
+
+    @property
+    def shape(self):
+        return (self.A.size, self.q.size)
+
+    @property
+    def h(self):
+        return self.A.size + self.q.size - 1
+
+    def W(self, engine="auto"):
+        return compute_W(self.A, self.q, engine=engine)
+
+    def row_sums(self):
+        # volumen total aportado por cada área
+        return self.A * self.q.sum()
+
+    def col_sums(self):
+        # volumen total generado en cada hora de lluvia
+        return self.A.sum() * self.q
+
+    def row(self, i):
+        return self.A[i] * self.q
+
+    def col(self, j):
+        return self.A * self.q[j]
+
+    def antidiagonal(self, k):
+        # aportes por área a W[k] (k base 0): V[i, k-i] para 0 <= k-i < p
+        a, p = self.shape
+        out = np.zeros(a)
+        lo, hi = max(0, k - p + 1), min(a, k + 1)
+        if lo < hi:
+            i = np.arange(lo, hi)
+            out[lo:hi] = self.A[lo:hi] * self.q[k - i]
+        return out
+
+    def block(self, rows=slice(None), cols=slice(None)):
+        return np.outer(self.A[rows], self.q[cols])
+
+    def toarray(self):
+        return np.outer(self.A, self.q)
+
+    def __array__(self, dtype=None, copy=None):
+        V = self.toarray()
+        return V if dtype is None else V.astype(dtype)
+
+    def __getitem__(self, idx):
+        # V[i, j] con enteros o slices (los slices devuelven el bloque denso)
+        i, j = idx
+        return np.multiply.outer(self.A[i], self.q[j])
+
+def compute_V_factored(A_m2, P_mm, Ce_vec, Cm_vec, units_mm=True):
+    return FactoredV(A_m2, compute_effective_depth(P_mm, Ce_vec, Cm_vec, units_mm=units_mm))
+
+def hour_contributions(V, k):
+    # aportes por área a la hora k (base 1) para V densa o factorizada
+    if isinstance(V, FactoredV):
+        return V.antidiagonal(k - 1)
+    V = np.asarray(V, dtype=float)
+    a, p = V.shape
+    out = np.zeros(a)
+    lo, hi = max(0, k - p), min(a, k)
+    if lo < hi:
+        i = np.arange(lo, hi)
+        out[lo:hi] = V[i, k - 1 - i]
+    return out
+
+# --------------------------
+# Tiempos de viaje arbitrarios
+# --------------------------
+# El modelo base supone que el área i llega a la salida i-1 horas después (retardos 0..a-1).
+# Con un retardo por área (horas, ≥ 0) las áreas de igual retardo se suman en un núcleo
+# u[L] = Σ A_i (bincount) y W = u * q con los mismos motores de compute_W. Un retardo
+# fraccionario L+f reparte el área entre las horas L (1-f) y L+1 (f).
+
+def default_lags(a):
+    return np.arange(a)
+
+def lag_kernel(A_m2, lags):
+    A = np.asarray(A_m2, dtype=float).reshape(-1)
+    lags = np.asarray(lags, dtype=float).reshape(-1)
+    if lags.size != A.size:
+        raise ValueError("Debe haber un retardo por área.")
+    if A.size == 0:
+        raise ValueError("No hay áreas.")
+    if not np.all(np.isfinite(lags)) or np.any(lags < 0):
+        raise ValueError("Los retardos deben ser finitos y no negativos.")
+    base = np.floor(lags).astype(np.intp)
+    frac = lags - base
+    if not frac.any():
+        return np.bincount(base, weights=A)
+    n = int((base + (frac > 0)).max()) + 1
+    return (np.bincount(base, weights=A * (1.0 - frac), minlength=n)[:n]
+            + np.bincount(base + 1, weights=A * frac, minlength=n)[:n])
+
+def compute_W_lagged(A_m2, q_eff, lags, engine="auto"):
+    # h = retardo máximo + p (con retardos 0..a-1 coincide con compute_W)
+    return compute_W(lag_kernel(A_m2, lags), q_eff, engine=engine)
+
+# --------------------------
+# Red de subcuencas
+# --------------------------
+# Cada subcuenca es una unidad PVCS que drena a otra (aguas abajo) con un retardo de canal.
+# Como todo es lineal, el hidrograma en la salida es la suma de los hidrogramas locales
+# desplazados por el retardo acumulado hasta ella; ese desplazamiento se suma al retardo de
+# cada área y todas las áreas con la misma tormenta se resuelven con un solo núcleo
+# (lag_kernel) y una convolución, en vez de enrutar nodo por nodo.
+
+class Subbasin:
+    __slots__ = ("id", "areas_km2", "downstream", "channel_lag", "lags", "storm")
+
+    def __init__(self, id, areas_km2, downstream=None, channel_lag=0.0, lags=None, storm=None):
+        self.id = id
+        self.areas_km2 = np.asarray(areas_km2, dtype=float).reshape(-1)
+        self.downstream = downstream
+        self.channel_lag = float(channel_lag)
+        # retardo por área dentro de la subcuenca (por defecto 0..a-1, como el modelo base)
+        self.lags = default_lags(self.areas_km2.size) if lags is None else np.asarray(lags, dtype=float).reshape(-1)
+        self.storm = storm
+        if self.areas_km2.size == 0:
+            raise ValueError(f"Subcuenca {id!r}: no tiene áreas.")
+        if self.lags.size != self.areas_km2.size:
+            raise ValueError(f"Subcuenca {id!r}: debe haber un retardo por área.")
+        if not np.all(np.isfinite(self.lags)) or np.any(self.lags < 0):
+            raise ValueError(f"Subcuenca {id!r}: los retardos deben ser finitos y no negativos.")
+        if self.channel_lag < 0 or not np.isfinite(self.channel_lag):
+            raise ValueError(f"Subcuenca {id!r}: el retardo de canal debe ser finito y no negativo.")
+
+def _network_order(subbasins):
+    # orden topológico de cabeceras a salidas; valida ids, destinos y ciclos
+    nodes = {}
+    for sb in subbasins:
+        if sb.id in nodes:
+            raise ValueError(f"Subcuenca repetida: {sb.id!r}.")
+        nodes[sb.id] = sb
+    upstream = {k: [] for k in nodes}
+    for sb in subbasins:
+        if sb.downstream is None and sb.channel_lag != 0:
+            # una salida no drena a ningún canal: su hidrograma es el de la salida misma
+            raise ValueError(f"Subcuenca {sb.id!r}: es una salida (sin destino) y no puede tener "
+                             f"retardo de canal ({sb.channel_lag:g} h).")
+        if sb.downstream is not None:
+            if sb.downstream not in nodes:
+                raise ValueError(f"Subcuenca {sb.id!r}: destino desconocido {sb.downstream!r}.")
+            upstream[sb.downstream].append(sb.id)
+    pending = {k: len(v) for k, v in upstream.items()}
+    order = [k for k, n in pending.items() if n == 0]
+    for k in order:
+        d = nodes[k].downstream
+        if d is not None:
+            pending[d] -= 1
+            if pending[d] == 0:
+                order.append(d)
+    if len(order) != len(nodes):
+        raise ValueError("La red de subcuencas tiene un ciclo.")
+    return nodes, upstream, order
+
+class NetworkResult:
+    # outlets: {id de salida: W}; path_lag: retardo de cada subcuenca hasta su salida;
+    # local (si se pidió): {id: W propio sin aportes de aguas arriba}
+    __slots__ = ("order", "outlets", "path_lag", "local", "_net")
+
+    def __init__(self, order, outlets, path_lag, local, net):
+        self.order = order
+        self.outlets = outlets
+        self.path_lag = path_lag
+        self.local = local
+        self._net = net
+
+    @property
+    def W(self):
+        # hidrograma de la única salida (error si la red tiene varias)
+        if len(self.outlets) != 1:
+            raise ValueError(f"La red tiene {len(self.outlets)} salidas; use outlets[id].")
+        return next(iter(self.outlets.values()))
+
+    @property
+    def flows(self):
+        return self.W / 3600.0
+
+    def upstream_of(self, node):
+        # la subcuenca y todas las que drenan a ella
+        upstream = self._net["upstream"]
+        out, stack = [], [node]
+        while stack:
+            k = stack.pop()
+            out.append(k)
+            stack.extend(upstream[k])
+        return out
+
+    def accumulated(self, node):
+        # hidrograma en la salida de `node` (propio + todo lo de aguas arriba, enrutado)
+        if node not in self.path_lag:
+            raise KeyError(node)
+        members = self.upstream_of(node)
+        return _network_route(self._net, members, {k: self.path_lag[k] - self.path_lag[node] for k in members})
+
+def _network_route(net, members, shift, workers=1):
+    # suma enrutada de `members`: un núcleo por tormenta con los retardos desplazados
+    groups = {}
+    for k in members:
+        groups.setdefault(net["storm"][k], []).append(k)
+
+    def route(storm):
+        ks = groups[storm]
+        A = np.concatenate([net["nodes"][k].areas_km2 for k in ks]) * 1e6
+        L = np.concatenate([net["nodes"][k].lags + shift[k] for k in ks])
+        return compute_W(lag_kernel(A, L), net["q"][storm], engine=net["engine"])
+
+    if workers > 1 and len(groups) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(route, groups))
+    else:
+        parts = [route(g) for g in groups]
+    W = np.zeros(max(w.size for w in parts))
+    for w in parts:
+        W[:w.size] += w
+    return W
+
+def _network_local(net, ks):
+    # hidrogramas locales de subcuencas con la misma tormenta: sus núcleos (lag_kernel) como
+    # filas de una matriz armada con un solo bincount, convolucionadas con q por compute_W_batch
+    nodes = net["nodes"]
+    q = net["q"][net["storm"][ks[0]]]
+    p = q.size
+    sizes = np.array([nodes[k].areas_km2.size for k in ks])
+    A = np.concatenate([nodes[k].areas_km2 for k in ks]) * 1e6
+    L = np.concatenate([nodes[k].lags for k in ks])
+    base = np.floor(L).astype(np.intp)
+    frac = L - base
+    own = np.maximum.reduceat(base + (frac > 0), np.r_[0, np.cumsum(sizes)[:-1]]) + 1
+    n, w = len(ks), int(own.max())
+    row = np.repeat(np.arange(n), sizes) * w
+    U = np.bincount(row + base, weights=A * (1.0 - frac), minlength=n * w)[:n * w]
+    U += np.bincount(row + base + 1, weights=A * frac, minlength=n * w)[:n * w]
+    W = compute_W_batch(q, U.reshape(n, w), engine=net["engine"])
+    return {k: W[r, :own[r] + p - 1].copy() for r, k in enumerate(ks)}
+
+def simulate_network(subbasins, storms, units_mm=True, engine="auto", workers=None, keep_local=False):
+    # storms: (P_mm, Ce, Cm) común a toda la red, o {nombre: (P_mm, Ce, Cm)} con
+    # Subbasin.storm indicando cuál usa cada subcuenca
+    nodes, upstream, order = _network_order(subbasins)
+    if not nodes:
+        raise ValueError("La red no tiene subcuencas.")
+    if isinstance(storms, dict):
+        q = {k: compute_effective_depth(*v, units_mm=units_mm) for k, v in storms.items()}
+        storm = {k: sb.storm for k, sb in nodes.items()}
+        missing = set(storm.values()) - set(q)
+        if missing:
+            raise ValueError(f"Tormentas no definidas: {', '.join(map(str, sorted(missing, key=str)))}.")
+    else:
+        q = {None: compute_effective_depth(*storms, units_mm=units_mm)}
+        storm = dict.fromkeys(nodes)
+    net = {"nodes": nodes, "upstream": upstream, "q": q, "storm": storm, "engine": engine}
+    # retardo acumulado hasta la salida (de la salida hacia las cabeceras)
+    path_lag, roots = {}, {}
+    for k in reversed(order):
+        sb = nodes[k]
+        if sb.downstream is None:
+            path_lag[k], roots[k] = 0.0, k
+        else:
+            path_lag[k] = sb.channel_lag + path_lag[sb.downstream]
+            roots[k] = roots[sb.downstream]
+    workers = workers or os.cpu_count() or 1
+    by_root = {}
+    for k in order:
+        by_root.setdefault(roots[k], []).append(k)
+
+    def outlet(root):
+        return root, _network_route(net, by_root[root], path_lag)
+
+    # hidrogramas locales por tormenta, en tandas de filas para acotar la memoria
+    local_jobs = []
+    if keep_local:
+        by_storm = {}
+        for k in order:
+            by_storm.setdefault(storm[k], []).append(k)
+        for ks in by_storm.values():
+            p = q[storm[ks[0]]].size
+            step = max(1, ENSEMBLE_FFT_MAX_CELLS // p)
+            local_jobs += [ks[i:i + step] for i in range(0, len(ks), step)]
+
+    def locals_of(ks):
+        return _network_local(net, ks)
+
+    # ramas independientes (salidas o tormentas distintas, hidrogramas locales) en
+    # paralelo: numpy libera el GIL durante las FFT y convoluciones
+    local_W = {} if keep_local else None
+    if workers == 1:
+        outlets = dict(map(outlet, by_root))
+        for part in map(locals_of, local_jobs):
+            local_W.update(part)
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        if len(by_root) == 1:
+            root = next(iter(by_root))
+            outlets = {root: _network_route(net, by_root[root], path_lag, workers=workers)}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            if len(by_root) > 1:
+                outlets = dict(pool.map(outlet, by_root))
+            for part in pool.map(locals_of, local_jobs):
+                local_W.update(part)
+    if keep_local:
+        local_W = {k: local_W[k] for k in order}
+    return NetworkResult(order, outlets, path_lag, local_W, net)
+
+# --------------------------
+# Ensambles de tormentas
+# --------------------------
+# Tamaño máximo (en celdas complejas) de cada lote FFT del ensamble
+ENSEMBLE_FFT_MAX_CELLS = 1 << 22
+# en lote la FFT se amortiza sobre todas las tormentas: desplazar-sumar sólo si es muy corto
+ENSEMBLE_DIRECT_MAX_KERNEL = 8
+
+class EnsembleResult:
+    __slots__ = ("W", "flows", "peak_flow", "peak_hour", "total_volume")
+
+    def __init__(self, W):
+        self.W = W
+        self.flows = W / 3600.0
+        idx = np.argmax(self.flows, axis=1)
+        self.peak_flow = self.flows[np.arange(W.shape[0]), idx]
+        self.peak_hour = idx + 1
+        self.total_volume = W.sum(axis=1)
+
+    @property
+    def n_storms(self):
+        return self.W.shape[0]
+
+def _as_storm_matrix(x, n, p, name):
+    m = np.asarray(x, dtype=float)
+    if m.ndim == 1:
+        m = m.reshape(1, -1)
+    if m.ndim != 2 or m.shape[1] != p or m.shape[0] not in (1, n):
+        raise ValueError(f"{name} debe tener forma ({n}, {p}) o ({p},); se recibió {np.shape(x)}.")
+    return m
+
+def compute_W_batch(A_m2, q_batch, engine="auto"):
+    # W de n tormentas a la vez: filas de q_batch convolucionadas con A
+    A = np.asarray(A_m2, dtype=float).reshape(-1)
+    q = np.asarray(q_batch, dtype=float)
+    if q.ndim != 2:
+        raise ValueError("q_batch debe ser una matriz (n_tormentas × p).")
+    n, p = q.shape
+    a = A.size
+    if a == 0 or p == 0:
+        raise ValueError("Se necesita al menos un área y una precipitación.")
+    h = a + p - 1
+    if engine == "auto":
+        engine = "direct" if min(a, p) <= ENSEMBLE_DIRECT_MAX_KERNEL else "fft"
+    if engine == "loop":
+        return np.vstack([_W_loop(A, row) for row in q]) if n else np.zeros((0, h))
+    W = np.zeros((n, h))
+    if engine == "direct":
+        # desplazar y sumar sobre la dimensión más corta
+        if a <= p:
+            for i in range(a):
+                W[:, i:i + p] += A[i] * q
+        else:
+            for j in range(p):
+                W[:, j:j + a] += np.multiply.outer(q[:, j], A)
+        return W
+    if engine == "fft":
+        nfft = _next_pow2(h)
+        FA = np.fft.rfft(A, nfft)
+        step = max(1, ENSEMBLE_FFT_MAX_CELLS // (nfft // 2 + 1))
+        for s in range(0, n, step):
+            Fq = np.fft.rfft(q[s:s + step], nfft, axis=1)
+            W[s:s + step] = np.fft.irfft(Fq * FA, nfft, axis=1)[:, :h]
+        return W
+    raise ValueError(f"Motor de W desconocido: {engine!r} (opciones: {', '.join(W_ENGINES)}).")
+
+def simulate_ensemble(areas_km2, P_mm, Ce, Cm, units_mm=True, engine="auto"):
+    # P, Ce y Cm: matrices (n_tormentas × p); Ce/Cm también pueden ser un único vector (p,)
+    P = np.asarray(P_mm, dtype=float)
+    if P.ndim == 1:
+        P = P.reshape(1, -1)
+    if P.ndim != 2:
+        raise ValueError("P debe ser una matriz (n_tormentas × p).")
+    n, p = P.shape
+    Ce_m = _as_storm_matrix(Ce, n, p, "Ce")
+    Cm_m = _as_storm_matrix(Cm, n, p, "Cm")
+    if units_mm:
+        P = P / 1000.0
+    A_m2 = np.asarray(areas_km2, dtype=float).reshape(-1) * 1e6
+    return EnsembleResult(compute_W_batch(A_m2, P * Ce_m * Cm_m, engine=engine))
+
+# --------------------------
+# W por bloques (memoria acotada)
+# --------------------------
+# Techo de memoria por defecto para los bloques de trabajo (bytes)
+BLOCKED_MAX_BYTES = 256 * 1024 * 1024
+
+class BlockedWReport:
+    __slots__ = ("n_blocks", "block_shape", "dtype", "max_abs_error", "max_rel_error")
+
+    def __init__(self, n_blocks, block_shape, dtype, max_abs_error, max_rel_error):
+        self.n_blocks = n_blocks
+        self.block_shape = block_shape
+        self.dtype = dtype
+        self.max_abs_error = max_abs_error
+        self.max_rel_error = max_rel_error
+
+    def __repr__(self):
+        return (f"BlockedWReport(n_blocks={self.n_blocks}, block_shape={self.block_shape}, "
+                f"dtype={self.dtype}, max_abs_error={self.max_abs_error:.3g}, "
+                f"max_rel_error={self.max_rel_error:.3g})")
+
+def _block_sizes(a, p, max_bytes, cell_bytes):
+    # bloque ba×bp con ba*bp*cell_bytes <= max_bytes, lo más cuadrado posible
+    cells = max(1, int(max_bytes // cell_bytes))
+    side = max(1, int(cells ** 0.5))
+    ba = min(a, side)
+    bp = min(p, max(1, cells // ba))
+    return ba, bp
+
+def compute_W_blocked(V, max_bytes=BLOCKED_MAX_BYTES, dtype=np.float64, out=None,
+                      return_report=False, engine="auto"):
+    # V: FactoredV (p. ej. con q memmap de un registro de varios años) o matriz densa
+    # (también np.memmap). Recorre bloques de áreas × horas y suma cada antidiagonal
+    # parcial en W. out: ruta .npy para escribir W en un memmap (np.load(..., mmap_mode="r")).
+    factored = isinstance(V, FactoredV)
+    if not factored and not hasattr(V, "dtype"):
+        V = np.asarray(V, dtype=float)
+    a, p = V.shape
+    h = a + p - 1
+    dtype = np.dtype(dtype)
+    if out is None:
+        W = np.zeros(h, dtype=dtype)
+    else:
+        W = np.lib.format.open_memmap(out, mode="w+", dtype=dtype, shape=(h,))
+    if factored:
+        # sin matriz: la memoria del bloque es lineal en ba+bp (buffers FFT incluidos)
+        n = max(2, int(max_bytes // (8 * 8)))
+        ba, bp = min(a, n // 2), min(p, n // 2)
+    else:
+        ba, bp = _block_sizes(a, p, max_bytes // 2, max(V.dtype.itemsize, 8))
+    track = return_report and dtype != np.float64
+    err = np.zeros(h) if track else None
+    n_blocks = 0
+    for j0 in range(0, p, bp):
+        j1 = min(p, j0 + bp)
+        for i0 in range(0, a, ba):
+            i1 = min(a, i0 + ba)
+            if factored:
+                part = compute_W(V.A[i0:i1], V.q[j0:j1], engine=engine)
+            else:
+                blk = np.asarray(V[i0:i1, j0:j1], dtype=float)
+                part = np.zeros((i1 - i0) + (j1 - j0) - 1)
+                for i in range(i1 - i0):
+                    part[i:i + j1 - j0] += blk[i]
+            sl = slice(i0 + j0, i0 + j0 + part.size)
+            if track:
+                # error de redondeo de esta suma en la precisión de salida (respecto a float64)
+                exact = W[sl].astype(np.float64) + part
+                W[sl] = exact
+                err[sl] += np.abs(W[sl].astype(np.float64) - exact)
+            else:
+                W[sl] += part
+            n_blocks += 1
+    if isinstance(W, np.memmap):
+        W.flush()
+    if not return_report:
+        return W
+    if track:
+        max_abs = float(err.max())
+        scale = np.abs(W.astype(np.float64))
+        nz = scale > 0
+        max_rel = float((err[nz] / scale[nz]).max()) if nz.any() else 0.0
+    else:
+        max_abs = max_rel = 0.0
+    return W, BlockedWReport(n_blocks, (ba, bp), dtype.name, max_abs, max_rel)
+
+# --------------------------
+# Hidrograma en tiempo real
+# --------------------------
+class StreamingHydrograph:
+    # Recibe una hora (P, Ce, Cm) a la vez. La lluvia de la hora j aporta A_i*q_j a
+    # W_{j+i}, así que al llegar la hora j el valor W_j ya es definitivo. Sólo se
+    # guarda el búfer circular de a salidas pendientes: memoria O(a), coste O(a)/hora.
+    __slots__ = ("A", "units_mm", "k", "_buf", "_head")
+
+    def __init__(self, areas_km2, units_mm=True):
+        self.A = np.asarray(areas_km2, dtype=float).reshape(-1) * 1e6
+        if self.A.size == 0:
+            raise ValueError("Se necesita al menos un área.")
+        self.units_mm = units_mm
+        self.k = 0
+        self._buf = np.zeros(self.A.size)
+        self._head = 0
+
+    @property
+    def a(self):
+        return self.A.size
+
+    def pending(self):
+        # volúmenes ya comprometidos para las próximas a horas (W_{k+1}, ..., W_{k+a})
+        return np.roll(self._buf, -self._head)
+
+    def _advance(self):
+        W_k = float(self._buf[self._head])
+        self._buf[self._head] = 0.0
+        self._head = (self._head + 1) % self.a
+        self.k += 1
+        return self.k, W_k, W_k / 3600.0
+
+    def push(self, P, Ce, Cm):
+        q = float(P) * float(Ce) * float(Cm)
+        if self.units_mm:
+            q /= 1000.0
+        n = self.a - self._head
+        self._buf[self._head:] += self.A[:n] * q
+        self._buf[:self._head] += self.A[n:] * q
+        return self._advance()
+
+    def feed(self, hours):
+        # generador: por cada (P, Ce, Cm) entrega (k, W_k, caudal_k) definitivo
+        for P, Ce, Cm in hours:
+            yield self.push(P, Ce, Cm)
+
+    def flush(self):
+        # fin de la lluvia: entrega la recesión restante (a-1 horas)
+        for _ in range(self.a - 1):
+            yield self._advance()
+
+# --------------------------
+# Barrido de sensibilidad (Ce/Cm)
+# --------------------------
+# Escenarios por tarea enviada al pool
+SWEEP_CHUNK = 256
+# Columnas de la malla de escenarios
+SWEEP_COLUMNS = ("variante_area", "escala_Ce", "escala_Cm", "escala_tormenta")
+
+class SweepResult:
+    __slots__ = ("grid", "peak_flow", "peak_hour", "total_volume", "W",
+                 "elapsed", "n_computed", "throughput", "ce_clipped")
+
+    def __init__(self, grid, stats, W, elapsed, n_computed, throughput, ce_clipped):
+        self.grid = grid
+        self.peak_flow = stats[:, 0]
+        self.peak_hour = stats[:, 1].astype(int)
+        self.total_volume = stats[:, 2]
+        self.W = W
+        self.elapsed = elapsed
+        self.n_computed = n_computed
+        # escenarios/segundo por proceso de trabajo (pid -> tasa)
+        self.throughput = throughput
+        # escenarios en que Ce escalado superó 1 en alguna hora y se limitó: sus resultados
+        # no crecen con la escala de Ce
+        self.ce_clipped = ce_clipped
+
+    @property
+    def rate(self):
+        return self.n_computed / self.elapsed if self.elapsed > 0 else float("inf")
+
+def sweep_grid(n_area_variants, ce_scales, cm_scales, storm_scales=(1.0,)):
+    # producto cartesiano; la variante de área es el eje más externo para que cada
+    # bloque de escenarios comparta casi siempre las mismas áreas
+    axes = np.meshgrid(np.arange(n_area_variants, dtype=float),
+                       np.asarray(ce_scales, dtype=float).reshape(-1),
+                       np.asarray(cm_scales, dtype=float).reshape(-1),
+                       np.asarray(storm_scales, dtype=float).reshape(-1), indexing="ij")
+    return np.stack([ax.reshape(-1) for ax in axes], axis=1)
+
+# estado de cada proceso de trabajo: vistas sobre memoria compartida / memmaps
+_sweep_state = {}
+
+def _sweep_key(grid, areas, P, Ce, Cm, units_mm, engine):
+    # identifica el barrido de un checkpoint: contenido y orden de la malla y de las entradas
+    import hashlib
+    hsh = hashlib.blake2b(digest_size=20)
+    hsh.update(b"mm" if units_mm else b"m")
+    hsh.update(str(engine).encode())
+    for arr in (grid, areas, P, Ce, Cm):
+        arr = np.ascontiguousarray(np.asarray(arr, dtype=np.float64))
+        hsh.update(repr(arr.shape).encode())
+        hsh.update(arr.data)
+    return hsh.hexdigest()
+
+def _shutdown_pool(pool, futures=()):
+    # cancela las tareas pendientes; cancel_futures sólo existe desde Python 3.9
+    for fut in futures:
+        fut.cancel()
+    if sys.version_info >= (3, 9):
+        pool.shutdown(cancel_futures=True)
+    else:
+        pool.shutdown()
+
+def _sweep_share(arr):
+    from multiprocessing import shared_memory
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, ("shm", shm.name, arr.shape, arr.dtype.str)
+
+def _sweep_open(spec):
+    if spec[0] == "file":
+        return None, np.load(spec[1], mmap_mode="r+")
+    from multiprocessing import shared_memory
+    _, name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+
+def _sweep_detach():
+    handles = _sweep_state.get("_handles", [])
+    _sweep_state.clear()
+    for shm in handles:
+        if shm is not None:
+            shm.close()
+
+def _sweep_attach(specs, units_mm, engine):
+    _sweep_detach()
+    handles = []
+    for key, spec in specs.items():
+        shm, view = _sweep_open(spec)
+        handles.append(shm)
+        _sweep_state[key] = view
+    _sweep_state["_handles"] = handles
+    _sweep_state["units_mm"] = units_mm
+    _sweep_state["engine"] = engine
+
+def _sweep_chunk(s0, s1):
+    import time
+    t0 = time.perf_counter()
+    st = _sweep_state
+    grid = st["grid"][s0:s1]
+    P, Ce, Cm = st["P"], st["Ce"], st["Cm"]
+    scale = 1e-3 if st["units_mm"] else 1.0
+    for v in np.unique(grid[:, 0]).astype(int):
+        rows = np.nonzero(grid[:, 0] == v)[0]
+        g = grid[rows]
+        # Ce es un coeficiente de escorrentía: al escalarlo se limita a [0, 1]
+        q = (scale * g[:, 3:4] * P) * np.clip(g[:, 1:2] * Ce, 0.0, 1.0) * (g[:, 2:3] * Cm)
+        W = compute_W_batch(st["areas"][v], q, engine=st["engine"])
+        idx = np.argmax(W, axis=1)
+        out = st["stats"]
+        out[s0 + rows, 0] = W[np.arange(rows.size), idx] / 3600.0
+        out[s0 + rows, 1] = idx + 1
+        out[s0 + rows, 2] = W.sum(axis=1)
+        if "W" in st:
+            st["W"][s0 + rows] = W
+    for key in ("stats", "W"):
+        if isinstance(st.get(key), np.memmap):
+            st[key].flush()
+    return s0, s1, os.getpid(), time.perf_counter() - t0
+
+def run_sweep(areas_km2, P_mm, Ce, Cm, ce_scales=(1.0,), cm_scales=(1.0,), storm_scales=(1.0,),
+              area_factors=None, workers=None, keep_W=False, checkpoint=None,
+              chunk=SWEEP_CHUNK, units_mm=True, engine="auto"):
+    # area_factors: lista de escalas (una por variante) o matriz (variantes × a) de
+    # perturbaciones por área. checkpoint: carpeta donde se guardan los resultados en
+    # memmaps; si ya existe se reanudan sólo los escenarios pendientes.
+    import json
+    import time
+    A = np.asarray(areas_km2, dtype=float).reshape(-1) * 1e6
+    P = np.asarray(P_mm, dtype=float).reshape(-1)
+    Ce = np.asarray(Ce, dtype=float).reshape(-1)
+    Cm = np.asarray(Cm, dtype=float).reshape(-1)
+    compute_effective_depth(P, Ce, Cm)  # misma validación de longitudes que el simulador
+    if area_factors is None:
+        area_factors = [1.0]
+    af = np.asarray(area_factors, dtype=float)
+    if af.ndim == 1:
+        af = af.reshape(-1, 1)
+    if af.ndim != 2 or af.shape[1] not in (1, A.size):
+        raise ValueError(f"area_factors debe ser (variantes,) o (variantes, {A.size}).")
+    areas = af * A
+    ce_scales = np.asarray(ce_scales, dtype=float).reshape(-1)
+    if not np.all(np.isfinite(ce_scales)) or np.any(ce_scales < 0):
+        raise ValueError("Las escalas de Ce deben ser números no negativos.")
+    grid = sweep_grid(areas.shape[0], ce_scales, cm_scales, storm_scales)
+    n, h = grid.shape[0], A.size + P.size - 1
+
+    shms = []
+    specs = {}
+    outputs = {"stats": (n, 3)}
+    if keep_W:
+        outputs["W"] = (n, h)
+    if checkpoint is not None:
+        os.makedirs(checkpoint, exist_ok=True)
+        meta = {"n": n, "h": h, "keep_W": bool(keep_W),
+                "key": _sweep_key(grid, areas, P, Ce, Cm, units_mm, engine)}
+        meta_path = os.path.join(checkpoint, "sweep.json")
+        done_path = os.path.join(checkpoint, "done.npy")
+        if os.path.exists(meta_path):
+            with open(meta_path) as fh:
+                old = json.load(fh)
+            if old != meta:
+                raise ValueError(f"El checkpoint {checkpoint} corresponde a otro barrido.")
+            done = np.load(done_path, mmap_mode="r+")
+        else:
+            for key, shape in outputs.items():
+                np.lib.format.open_memmap(os.path.join(checkpoint, key + ".npy"), mode="w+",
+                                          dtype=np.float64, shape=shape).flush()
+            done = np.lib.format.open_memmap(done_path, mode="w+", dtype=np.bool_, shape=(n,))
+            with open(meta_path, "w") as fh:
+                json.dump(meta, fh)
+        for key in outputs:
+            specs[key] = ("file", os.path.join(checkpoint, key + ".npy"))
+    else:
+        done = np.zeros(n, dtype=bool)
+        for key, shape in outputs.items():
+            shm, specs[key] = _sweep_share(np.zeros(shape))
+            shms.append(shm)
+    # entradas en memoria compartida: los procesos las leen sin copiarlas por tarea
+    for key, arr in (("areas", areas), ("P", P), ("Ce", Ce), ("Cm", Cm), ("grid", grid)):
+        shm, specs[key] = _sweep_share(arr)
+        shms.append(shm)
+    results_out = {}
+
+    tasks = [(s, min(n, s + chunk)) for s in range(0, n, chunk) if not done[s:s + chunk].all()]
+    busy = {}
+    t0 = time.perf_counter()
+    n_computed = 0
+    try:
+        if workers is None:
+            workers = os.cpu_count() or 1
+        futures = []
+        if workers <= 1 or len(tasks) <= 1:
+            _sweep_attach(specs, units_mm, engine)
+            results = (_sweep_chunk(s0, s1) for s0, s1 in tasks)
+            pool = None
+        else:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor, as_completed
+            # sin fork, igual que el servicio y la animación: el proceso que llama puede tener
+            # hilos o Tk abiertos. Las entradas viajan por memoria compartida, no por copia del padre.
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=_sweep_attach,
+                                       initargs=(specs, units_mm, engine),
+                                       mp_context=multiprocessing.get_context(method))
+            futures = [pool.submit(_sweep_chunk, s0, s1) for s0, s1 in tasks]
+            results = (f.result() for f in as_completed(futures))
+        try:
+            for s0, s1, pid, dt in results:
+                done[s0:s1] = True
+                n_computed += s1 - s0
+                cnt, tot = busy.get(pid, (0, 0.0))
+                busy[pid] = (cnt + s1 - s0, tot + dt)
+        finally:
+            if pool is not None:
+                _shutdown_pool(pool, futures)
+            if isinstance(done, np.memmap):
+                done.flush()
+        elapsed = time.perf_counter() - t0
+        for key in outputs:
+            if checkpoint is not None:
+                results_out[key] = np.load(os.path.join(checkpoint, key + ".npy"), mmap_mode="r")
+            else:
+                _, name, shape, dtype = specs[key]
+                shm = shms[[x.name for x in shms].index(name)]
+                results_out[key] = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf).copy()
+    finally:
+        _sweep_detach()
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    throughput = {pid: (cnt / tot if tot > 0 else float("inf")) for pid, (cnt, tot) in busy.items()}
+    ce_clipped = grid[:, 1] * (Ce.max() if Ce.size else 0.0) > 1.0
+    return SweepResult(grid, results_out["stats"], results_out.get("W"), elapsed, n_computed, throughput,
+                       ce_clipped)
+
+# --------------------------
+# Calibración (Ce/Cm)
+# --------------------------
+# W es lineal en la lámina eficaz q_j = P_j·Ce_j·Cm_j, así que ajustar Ce (o un factor de
+# Cm) a caudales observados es un problema de mínimos cuadrados acotado. El operador
+# x -> caudales es una convolución con A (Toeplitz) y se aplica por FFT junto con su
+# adjunta (correlación); nunca se arma la matriz h×p. Se resuelve por gradiente proyectado
+# con pasos de gradiente conjugado sobre las variables libres. Ce y Cm sólo aparecen como
+# producto: se ajusta uno con el otro fijo.
+# Aplicaciones máximas del operador y tolerancia relativa del gradiente proyectado
+CALIB_MAX_ITER = 2000
+CALIB_TOL = 1e-6
+# Reducción relativa del residuo con que termina cada tanda de gradiente conjugado
+CALIB_CG_RTOL = 0.1
+CALIB_FITS = ("ce", "cm")
+
+class CalibrationResult:
+    # params: un valor por grupo; Ce/Cm: series horarias resultantes; residuals = observado -
+    # ajustado (NaN donde no hay observación); identifiable: grupos con lluvia (los demás
+    # conservan el valor inicial)
+    __slots__ = ("fit", "params", "groups", "Ce", "Cm", "W", "flows", "residuals", "rmse", "nse",
+                 "volume_error", "iterations", "converged", "identifiable")
+
+    def __init__(self, **kw):
+        for name in self.__slots__:
+            setattr(self, name, kw[name])
+
+    def summary(self):
+        return (f"Calibración de {self.fit.upper()}: {self.params.size} parámetros, "
+                f"{self.iterations} iteraciones{'' if self.converged else ' (sin converger)'}; "
+                f"RMSE={self.rmse:.4g} m³/s, NSE={self.nse:.4f}, error de volumen={self.volume_error:+.2%}")
+
+def rain_event_groups(P_mm, min_dry_hours=6, threshold=0.0):
+    # etiqueta de evento por hora, con los mismos eventos que find_events: cada evento sigue
+    # (con sus horas secas) hasta que empieza el siguiente
+    P = np.asarray(P_mm, dtype=float).reshape(-1)
+    starts, _ = find_events(P, min_dry_hours=min_dry_hours, threshold=threshold)
+    if starts.size == 0:
+        return np.zeros(P.size, dtype=np.intp)
+    # las horas secas previas a la primera lluvia quedan en el primer evento
+    return np.maximum(np.cumsum(np.bincount(starts, minlength=P.size)) - 1, 0)
+
+def _calib_groups(groups, p):
+    if groups is None or (isinstance(groups, str) and groups == "hourly"):
+        return np.arange(p)
+    if isinstance(groups, str) and groups == "global":
+        return np.zeros(p, dtype=np.intp)
+    g = np.asarray(groups).reshape(-1)
+    if g.size != p:
+        raise ValueError(f"groups debe tener una etiqueta por hora ({p}); se recibieron {g.size}.")
+    # etiquetas arbitrarias -> 0..n-1 en orden de aparición
+    _, first, inv = np.unique(g, return_index=True, return_inverse=True)
+    return np.argsort(np.argsort(first))[inv]
+
+def calibrate(areas_km2, P_mm, observed_flows, Ce=None, Cm=None, groups=None, fit="ce",
+              bounds=None, units_mm=True, max_iter=CALIB_MAX_ITER, tol=CALIB_TOL):
+    # observed_flows: caudal en la salida (m³/s) desde la hora 1; se compara en las horas
+    # comunes con el modelo y se ignoran las observaciones NaN.
+    # groups: None/"hourly" (un valor por hora), "global" (uno solo) o una etiqueta por hora
+    # (p. ej. rain_event_groups). fit="ce" ajusta Ce con Cm fijo; fit="cm", un factor de Cm.
+    if fit not in CALIB_FITS:
+        raise ValueError(f"fit desconocido: {fit!r} (opciones: {', '.join(CALIB_FITS)}).")
+    A = np.asarray(areas_km2, dtype=float).reshape(-1) * 1e6
+    P = np.asarray(P_mm, dtype=float).reshape(-1)
+    a, p = A.size, P.size
+    if a == 0 or p == 0:
+        raise ValueError("Se necesita al menos un área y una precipitación.")
+    Ce = np.full(p, DEFAULT_CE) if Ce is None else np.asarray(Ce, dtype=float).reshape(-1)
+    Cm = np.full(p, DEFAULT_CM) if Cm is None else np.asarray(Cm, dtype=float).reshape(-1)
+    # misma validación de longitudes que el resto del núcleo
+    compute_effective_depth(P, Ce, Cm, units_mm=units_mm)
+    if bounds is None:
+        bounds = (0.0, 1.0) if fit == "ce" else (0.0, np.inf)
+    lo, hi = float(bounds[0]), float(bounds[1])
+    if not lo <= hi:
+        raise ValueError("bounds debe cumplir inferior <= superior.")
+    g = _calib_groups(groups, p)
+    n_par = int(g.max()) + 1
+    h = a + p - 1
+    obs = np.asarray(observed_flows, dtype=float).reshape(-1)[:h]
+    n = obs.size
+    mask = np.isfinite(obs)
+    if not mask.any():
+        raise ValueError("No hay caudales observados válidos.")
+    y = np.where(mask, obs, 0.0)
+
+    # q_j = c_j · x_{g(j)}; caudal = (A * q) / 3600
+    scale = P / 1000.0 if units_mm else P.copy()
+    c = scale * Cm if fit == "ce" else scale * Ce
+    base = Ce if fit == "ce" else np.ones(p)
+    nfft = _next_pow2(h)
+    FA = np.fft.rfft(A, nfft) / 3600.0
+    FA_conj = FA.conj()
+
+    def forward(x):
+        return np.fft.irfft(FA * np.fft.rfft(c * x[g], nfft), nfft)[:n]
+
+    def adjoint(r):
+        return np.bincount(g, weights=c * np.fft.irfft(FA_conj * np.fft.rfft(r, nfft), nfft)[:p],
+                           minlength=n_par)
+
+    identifiable = np.bincount(g, weights=np.abs(c), minlength=n_par) > 0
+    # valor inicial: el actual (promedio por grupo), recortado a los límites
+    x = np.clip(np.bincount(g, weights=base, minlength=n_par) / np.bincount(g, minlength=n_par), lo, hi)
+
+    def residual(x):
+        return (forward(x) - y) * mask
+
+    # precondicionador diagonal: norma² aproximada de cada columna (sin cruces entre horas
+    # del grupo); corrige la escala muy distinta entre eventos grandes y chicos
+    D = np.bincount(g, weights=c * c, minlength=n_par) * float(A @ A) / 3600.0 ** 2
+    D = np.where(D > 0, D, 1.0)
+
+    # proyección de gradiente + gradiente conjugado sobre las variables libres (las que no
+    # están en un límite empujadas hacia afuera); cada paso se proyecta con búsqueda lineal
+    r = residual(x)
+    f = 0.5 * float(r @ r)
+    grad = adjoint(r)
+    # escalas absolutas: si el valor inicial ya ajusta, el gradiente relativo al primero no
+    # baja nunca y sin estos topes se agotarían las iteraciones
+    y_norm = float(np.linalg.norm(y))
+    g_scale = float(np.linalg.norm(np.where(identifiable, adjoint(y), 0.0)))
+    pg0 = None
+    converged = False
+    it = 0
+    while it < max_iter:
+        pg = np.where(identifiable, x - np.clip(x - grad, lo, hi), 0.0)
+        pg_norm = np.linalg.norm(pg)
+        pg0 = pg_norm if pg0 is None else pg0
+        if (pg_norm <= tol * max(pg0, 1e-300) or pg_norm <= tol * g_scale
+                or np.sqrt(2.0 * f) <= tol * y_norm):
+            converged = True
+            break
+        free = identifiable & ~((x <= lo) & (grad > 0)) & ~((x >= hi) & (grad < 0))
+        d = np.zeros(n_par)
+        res = np.where(free, -grad, 0.0)
+        z = res / D
+        dirn = z.copy()
+        rz = float(res @ z)
+        rs0 = float(res @ res)
+        while float(res @ res) > (CALIB_CG_RTOL ** 2) * rs0 and it < max_iter:
+            Ad = np.where(free, adjoint(forward(dirn) * mask), 0.0)
+            it += 1
+            curv = float(dirn @ Ad)
+            if curv <= 0:
+                break
+            alpha = rz / curv
+            d += alpha * dirn
+            res -= alpha * Ad
+            z = res / D
+            rz_new = float(res @ z)
+            dirn = z + (rz_new / rz) * dirn
+            rz = rz_new
+        if not d.any():
+            d = np.where(free, -grad / D, 0.0)
+        s_len = 1.0
+        for _ in range(40):
+            x_try = np.clip(x + s_len * d, lo, hi)
+            r_try = residual(x_try)
+            f_try = 0.5 * float(r_try @ r_try)
+            if f_try <= f + 1e-4 * float(grad @ (x_try - x)):
+                break
+            s_len *= 0.5
+        else:
+            converged = True
+            break
+        if np.array_equal(x_try, x):
+            # paso aceptado que no mueve x: ya no se puede mejorar
+            converged = True
+            break
+        x, r, f = x_try, r_try, f_try
+        grad = adjoint(r)
+
+    fitted = x[g]
+    Ce_fit = fitted if fit == "ce" else Ce.copy()
+    Cm_fit = Cm.copy() if fit == "ce" else Cm * fitted
+    W = compute_W(A, compute_effective_depth(P, Ce_fit, Cm_fit, units_mm=units_mm))
+    flows = W / 3600.0
+    residuals = np.where(mask, obs - flows[:n], np.nan)
+    r = residuals[mask]
+    o = obs[mask]
+    rmse = float(np.sqrt(np.mean(r * r)))
+    var = float(np.sum((o - o.mean()) ** 2))
+    nse = 1.0 - float(np.sum(r * r)) / var if var > 0 else float("nan")
+    vol_obs = float(o.sum())
+    volume_error = float((flows[:n][mask].sum() - vol_obs) / vol_obs) if vol_obs else float("nan")
+    return CalibrationResult(fit=fit, params=x, groups=g, Ce=Ce_fit, Cm=Cm_fit, W=W, flows=flows,
+                             residuals=residuals, rmse=rmse, nse=nse, volume_error=volume_error,
+                             iterations=it, converged=converged, identifiable=identifiable)
+
+# --------------------------
+# Eventos en registros largos
+# --------------------------
+# Un evento es una racha de horas con lluvia (P > umbral) que termina cuando siguen al
+# menos min_dry_hours horas secas. Se detectan en una pasada vectorizada y se simulan en
+# lotes de compute_W_batch agrupando eventos de duración parecida (potencias de 2), así
+# el relleno por lote es < 2× y el costo total crece linealmente con el registro.
+EVENT_COLUMNS = ("rank", "event", "start_hour", "end_hour", "duration_h", "depth_mm",
+                 "peak_flow_m3s", "peak_hour", "volume_m3")
+
+def find_events(P_mm, min_dry_hours=6, threshold=0.0, min_depth=0.0):
+    # -> (inicio, fin) en índices 0-based, fin exclusivo (hora siguiente a la última con lluvia).
+    # threshold y min_depth van en las unidades de P. Es el único separador de eventos:
+    # rain_event_groups (calibración) se arma sobre él.
+    P = np.asarray(P_mm, dtype=float).reshape(-1)
+    wet = np.flatnonzero(P > threshold)
+    if wet.size == 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    cut = np.flatnonzero(np.diff(wet) - 1 >= min_dry_hours)
+    starts = wet[np.r_[0, cut + 1]]
+    ends = wet[np.r_[cut, wet.size - 1]] + 1
+    if min_depth > 0:
+        cs = np.r_[0.0, np.cumsum(P)]
+        keep = cs[ends] - cs[starts] >= min_depth
+        starts, ends = starts[keep], ends[keep]
+    return starts, ends
+
+class EventTable:
+    # una fila por evento, ordenada por caudal pico descendente; horas 1-based del registro
+    __slots__ = ("event", "start_hour", "end_hour", "duration", "depth_mm", "peak_flow",
+                 "peak_hour", "volume")
+
+    def __init__(self, **kw):
+        for name in self.__slots__:
+            setattr(self, name, kw[name])
+
+    def __len__(self):
+        return self.event.size
+
+    def top(self, n):
+        return EventTable(**{name: getattr(self, name)[:n] for name in self.__slots__})
+
+    def as_array(self):
+        # columnas EVENT_COLUMNS
+        return np.column_stack([np.arange(1, len(self) + 1), self.event + 1, self.start_hour, self.end_hour,
+                                self.duration, self.depth_mm, self.peak_flow, self.peak_hour, self.volume])
+
+    def write_csv(self, path):
+        with open(path, "w", newline="") as fh:
+            fh.write(",".join(EVENT_COLUMNS) + "\r\n")
+            _write_text_rows(fh, "%d,%d,%d,%d,%d,%.6f,%.6f,%d,%.6f\r\n", self.as_array())
+
+def simulate_events(areas_km2, P_mm, Ce=None, Cm=None, min_dry_hours=6, threshold=0.0,
+                    min_depth=0.0, units_mm=True, engine="auto"):
+    # cada evento se simula aislado: su lluvia (con Ce/Cm de esas horas) y la respuesta
+    # completa de la cuenca, a-1 horas después de la última lluvia
+    A = np.asarray(areas_km2, dtype=float).reshape(-1) * 1e6
+    P = np.asarray(P_mm, dtype=float).reshape(-1)
+    p = P.size
+    Ce = np.full(p, DEFAULT_CE) if Ce is None else Ce
+    Cm = np.full(p, DEFAULT_CM) if Cm is None else Cm
+    q = compute_effective_depth(P, Ce, Cm, units_mm=units_mm)
+    # threshold y min_depth se dan en mm; P puede venir en m
+    to_p = 1.0 if units_mm else 1e-3
+    starts, ends = find_events(P, min_dry_hours=min_dry_hours, threshold=threshold * to_p,
+                               min_depth=min_depth * to_p)
+    n = starts.size
+    lengths = ends - starts
+    peak_flow = np.zeros(n)
+    peak_idx = np.zeros(n, dtype=np.intp)
+    volume = np.zeros(n)
+    buckets = np.ceil(np.log2(np.maximum(lengths, 1))).astype(np.intp) if n else lengths
+    for b in np.unique(buckets):
+        ids = np.flatnonzero(buckets == b)
+        L = int(lengths[ids].max())
+        rows = max(1, ENSEMBLE_FFT_MAX_CELLS // (L + A.size))
+        for s0 in range(0, ids.size, rows):
+            blk = ids[s0:s0 + rows]
+            # lluvia eficaz de cada evento como fila (relleno con ceros hasta L)
+            offs = np.arange(L)
+            take = starts[blk, None] + offs
+            valid = offs < lengths[blk, None]
+            Q = np.where(valid, q[np.minimum(take, p - 1)], 0.0)
+            W = compute_W_batch(A, Q, engine=engine)
+            k = np.argmax(W, axis=1)
+            peak_idx[blk] = k
+            peak_flow[blk] = W[np.arange(blk.size), k] / 3600.0
+            volume[blk] = W.sum(axis=1)
+    cs = np.r_[0.0, np.cumsum(P)]
+    order = np.lexsort((starts, -peak_flow))
+    return EventTable(event=order, start_hour=starts[order] + 1, end_hour=ends[order],
+                      duration=lengths[order], depth_mm=(cs[ends] - cs[starts])[order] * (1.0 if units_mm else 1000.0),
+                      peak_flow=peak_flow[order], peak_hour=starts[order] + peak_idx[order] + 1,
+                      volume=volume[order])
+
+# --------------------------
+# Instrumentación
+# --------------------------
+# Si está definida, cada corrida agrega su traza (JSON por línea) a este archivo
+TRACE_ENV = "SAH_TRACE"
+
+def _rss_kb():
+    # memoria residente actual del proceso en KiB; None si la plataforma no la expone.
+    # Linux: /proc/self/statm. En otros sistemas se usa el pico (ru_maxrss): su
+    # crecimiento durante una etapa sigue siendo atribuible a esa etapa.
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+# pico de tracemalloc anterior al último reset_peak de StageTimer: el pico global de la
+# captura es el máximo entre éste y el que informa tracemalloc (ver traced_peak)
+_traced_peak_seen = 0
+
+def _fold_traced_peak():
+    global _traced_peak_seen
+    import tracemalloc
+    _traced_peak_seen = max(_traced_peak_seen, tracemalloc.get_traced_memory()[1])
+
+def traced_peak():
+    # pico de tracemalloc desde que empezó la captura, aunque las etapas reinicien el suyo
+    import tracemalloc
+    return max(_traced_peak_seen, tracemalloc.get_traced_memory()[1])
+
+class StageTimer:
+    # Tiempo de pared y memoria de cada etapa de una corrida. Con tracemalloc activo (modo
+    # captura) la memoria es el pico de la etapa por encima de lo que ya estaba asignado al
+    # empezarla; si no, el cambio de memoria residente durante la etapa (ΔRSS: una
+    # diferencia entre el inicio y el fin, no un pico). No borra el pico global de la
+    # captura: antes de reiniciar el de la etapa lo acumula en traced_peak().
+    def __init__(self, label="simulate", **meta):
+        import time
+        self.label = label
+        self.meta = meta
+        self.started = time.time()
+        self.stages = []
+
+    def stage(self, name):
+        from contextlib import contextmanager
+
+        @contextmanager
+        def _stage():
+            import time
+            import tracemalloc
+            tracing = tracemalloc.is_tracing()
+            # reset_peak existe desde Python 3.9; en 3.8 sólo se mide la diferencia al terminar
+            peaks = tracing and hasattr(tracemalloc, "reset_peak")
+            if tracing:
+                if peaks:
+                    # el pico acumulado se guarda antes de reiniciar el de la etapa
+                    _fold_traced_peak()
+                    tracemalloc.reset_peak()
+                traced0 = tracemalloc.get_traced_memory()[0]
+            rss0 = _rss_kb()
+            t0 = time.perf_counter()
+            try:
+                yield
+            finally:
+                dt = time.perf_counter() - t0
+                rec = {"stage": name, "seconds": dt}
+                if tracing:
+                    _fold_traced_peak()
+                    current, peak = tracemalloc.get_traced_memory()
+                    rec["traced_bytes"] = (peak if peaks else current) - traced0
+                rss1 = _rss_kb()
+                if rss0 is not None and rss1 is not None:
+                    rec["rss_delta_kb"] = rss1 - rss0
+                self.stages.append(rec)
+        return _stage()
+
+    @property
+    def total(self):
+        return sum(r["seconds"] for r in self.stages)
+
+    @staticmethod
+    def _memory_text(rec):
+        if "traced_bytes" in rec:
+            return f" (pico +{rec['traced_bytes']/1e6:.1f} MB)"
+        if "rss_delta_kb" in rec:
+            return f" (ΔRSS {rec['rss_delta_kb']/1024:+.1f} MB)"
+        return ""
+
+    def summary(self):
+        parts = [f"{r['stage']} {r['seconds']*1000:.1f} ms{self._memory_text(r)}" for r in self.stages]
+        return "Tiempos: " + " · ".join(parts) + f" (total {self.total*1000:.1f} ms)"
+
+    def to_dict(self):
+        return {"label": self.label, "started": self.started, "total_seconds": self.total,
+                "stages": self.stages, **self.meta}
+
+    def export_jsonl(self, path):
+        import json
+        with open(path, "a", encoding="utf-8") as fh:
+            fh.write(json.dumps(self.to_dict()) + "\n")
+
+class ProfileCapture:
+    # captura opt-in de una corrida: cProfile + tracemalloc; guarda <prefijo>.prof y un resumen
+    def __init__(self, prefix, top=15):
+        self.prefix = prefix
+        self.top = top
+        self.report = ""
+
+    def __enter__(self):
+        import cProfile
+        import tracemalloc
+        global _traced_peak_seen
+        self._started_tm = not tracemalloc.is_tracing()
+        if self._started_tm:
+            tracemalloc.start()
+            _traced_peak_seen = 0
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        import io
+        import pstats
+        import tracemalloc
+        self.profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()[0], traced_peak()
+        if self._started_tm:
+            tracemalloc.stop()
+        self.profiler.dump_stats(self.prefix + ".prof")
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats("cumulative").print_stats(self.top)
+        out.write(f"\ntracemalloc: actual {current/1e6:.2f} MB, pico {peak/1e6:.2f} MB\n")
+        for stat in snapshot.statistics("lineno")[:self.top]:
+            out.write(f"{stat}\n")
+        self.report = out.getvalue()
+        with open(self.prefix + ".txt", "w", encoding="utf-8") as fh:
+            fh.write(self.report)
+        return False
+
+# --------------------------
+# Caché de simulaciones
+# --------------------------
+# Presupuesto por defecto de la caché en memoria (bytes)
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+def simulation_key(areas_km2, P_mm, Ce, Cm, units_mm=True):
+    # hash del contenido de las entradas (valores float64 y longitudes)
+    import hashlib
+    hsh = hashlib.blake2b(digest_size=20)
+    hsh.update(b"mm" if units_mm else b"m")
+    for arr in (areas_km2, P_mm, Ce, Cm):
+        arr = np.ascontiguousarray(np.asarray(arr, dtype=np.float64).reshape(-1))
+        hsh.update(arr.size.to_bytes(8, "little"))
+        hsh.update(arr.data)
+    return hsh.hexdigest()
+
+class CachedRun:
+    # resultado de una simulación; V se arma (factorizada) sólo cuando se pide
+    __slots__ = ("key", "A_m2", "q", "W", "flows", "peak_flow", "peak_hour", "total_volume", "_V")
+
+    def __init__(self, key, A_m2, q, W):
+        self.key = key
+        self.A_m2 = A_m2
+        self.q = q
+        self.W = W
+        self.flows = W / 3600.0
+        idx = int(np.argmax(self.flows))
+        self.peak_flow = float(self.flows[idx])
+        self.peak_hour = idx + 1
+        self.total_volume = float(W.sum())
+        self._V = None
+        for arr in (self.A_m2, self.q, self.W, self.flows):
+            arr.setflags(write=False)
+
+    @property
+    def V(self):
+        if self._V is None:
+            self._V = FactoredV(self.A_m2, self.q)
+        return self._V
+
+    @property
+    def nbytes(self):
+        return self.A_m2.nbytes + self.q.nbytes + self.W.nbytes + self.flows.nbytes
+
+class SimulationCache:
+    # LRU por contenido de las entradas con presupuesto de memoria y nivel opcional en disco
+    # (un .npz por corrida en disk_dir). hits/misses/disk_hits sirven para ajustar el tamaño.
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, disk_dir=None):
+        from collections import OrderedDict
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self._runs = OrderedDict()
+        self.nbytes = 0
+        self.hits = self.misses = self.disk_hits = self.evictions = 0
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._runs)
+
+    def __contains__(self, key):
+        return key in self._runs
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "disk_hits": self.disk_hits,
+                "evictions": self.evictions, "entries": len(self._runs), "bytes": self.nbytes,
+                "hit_rate": self.hits / total if total else 0.0}
+
+    def clear(self):
+        self._runs.clear()
+        self.nbytes = 0
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key + ".npz")
+
+    def _load_disk(self, key):
+        if self.disk_dir is None or not os.path.exists(self._disk_path(key)):
+            return None
+        try:
+            with np.load(self._disk_path(key)) as z:
+                return CachedRun(key, z["A_m2"], z["q"], z["W"])
+        except Exception:
+            return None
+
+    def put(self, run):
+        if run.key in self._runs:
+            self._runs.move_to_end(run.key)
+            return run
+        self._runs[run.key] = run
+        self.nbytes += run.nbytes
+        while self.nbytes > self.max_bytes and len(self._runs) > 1:
+            _, old = self._runs.popitem(last=False)
+            self.nbytes -= old.nbytes
+            self.evictions += 1
+        if self.disk_dir is not None and not os.path.exists(self._disk_path(run.key)):
+            tmp = self._disk_path(run.key) + ".tmp.npz"
+            np.savez(tmp, A_m2=run.A_m2, q=run.q, W=run.W)
+            os.replace(tmp, self._disk_path(run.key))
+        return run
+
+    def get(self, key):
+        run = self._runs.get(key)
+        if run is not None:
+            self._runs.move_to_end(key)
+            self.hits += 1
+            return run
+        run = self._load_disk(key)
+        if run is not None:
+            self.hits += 1
+            self.disk_hits += 1
+            return self.put(run)
+        return None
+
+    def get_or_compute(self, areas_km2, P_mm, Ce, Cm, units_mm=True, engine="auto", timer=None):
+        timer = timer or StageTimer()
+        with timer.stage("cache"):
+            key = simulation_key(areas_km2, P_mm, Ce, Cm, units_mm=units_mm)
+            run = self.get(key)
+        if run is not None:
+            return run
+        self.misses += 1
+        with timer.stage("q_eff"):
+            A_m2 = np.asarray(areas_km2, dtype=float).reshape(-1) * 1e6
+            q = compute_effective_depth(P_mm, Ce, Cm, units_mm=units_mm)
+        with timer.stage("W"):
+            W = compute_W(A_m2, q, engine=engine)
+        return self.put(CachedRun(key, A_m2, q, W))
+
+# --------------------------
+# Comparación de corridas
+# --------------------------
+# Corridas que guarda la sesión para comparar (las más viejas se descartan)
+RUNSTORE_MAX_RUNS = 64
+# Puntos por curva en la superposición (más horas se reducen a min/max por bloque)
+RUNSTORE_PLOT_POINTS = 2000
+COMPARE_COLUMNS = ("corrida", "a", "p", "h", "caudal_pico_m3s", "hora_pico", "volumen_m3",
+                   "dif_pico_m3s", "razon_pico", "dif_hora_pico", "razon_volumen", "max_abs_dif_m3s")
+
+def _array_key(arr):
+    import hashlib
+    hsh = hashlib.blake2b(digest_size=16)
+    hsh.update(arr.size.to_bytes(8, "little"))
+    hsh.update(arr.data)
+    return hsh.hexdigest()
+
+class StoredRun:
+    # corrida guardada para comparar: sólo W es propio (longitud h); A y q se comparten
+    # con las demás corridas de igual contenido y V se arma factorizada al pedirla
+    __slots__ = ("label", "key", "A_m2", "q", "W", "peak_flow", "peak_hour", "total_volume", "meta")
+
+    def __init__(self, label, key, A_m2, q, W, meta=None):
+        self.label = label
+        self.key = key
+        self.A_m2 = A_m2
+        self.q = q
+        self.W = W
+        idx = int(np.argmax(W))
+        self.peak_flow = float(W[idx]) / 3600.0
+        self.peak_hour = idx + 1
+        self.total_volume = float(W.sum())
+        self.meta = meta or {}
+
+    @property
+    def flows(self):
+        return self.W / 3600.0
+
+    @property
+    def V(self):
+        return FactoredV(self.A_m2, self.q)
+
+    @property
+    def shape(self):
+        return (self.A_m2.size, self.q.size)
+
+class RunStore:
+    # Corridas de la sesión, por etiqueta y en orden de llegada. Las áreas y las láminas q
+    # idénticas se guardan una sola vez; la memoria crece con la suma de las h, no con a·p.
+    def __init__(self, max_runs=RUNSTORE_MAX_RUNS):
+        from collections import OrderedDict
+        self.max_runs = max_runs
+        self._runs = OrderedDict()
+        self._arrays = {}  # hash del contenido -> [arreglo de sólo lectura, referencias]
+        self._count = 0
+
+    def __len__(self):
+        return len(self._runs)
+
+    def __iter__(self):
+        return iter(self._runs.values())
+
+    def __contains__(self, label):
+        return label in self._runs
+
+    def __getitem__(self, label):
+        if isinstance(label, int):
+            return list(self._runs.values())[label]
+        try:
+            return self._runs[label]
+        except KeyError:
+            raise KeyError(f"No hay una corrida llamada {label!r}.") from None
+
+    @property
+    def labels(self):
+        return list(self._runs)
+
+    @property
+    def nbytes(self):
+        return (sum(r.W.nbytes for r in self._runs.values())
+                + sum(arr.nbytes for arr, _ in self._arrays.values()))
+
+    def _share(self, arr):
+        arr = np.ascontiguousarray(np.asarray(arr, dtype=np.float64).reshape(-1))
+        key = _array_key(arr)
+        entry = self._arrays.get(key)
+        if entry is None:
+            if arr.flags.writeable:
+                arr = arr.copy()
+                arr.setflags(write=False)
+            entry = self._arrays[key] = [arr, 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _release(self, run):
+        for arr in (run.A_m2, run.q):
+            key = _array_key(arr)
+            entry = self._arrays.get(key)
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self._arrays[key]
+
+    def find(self, key):
+        for run in self._runs.values():
+            if key is not None and run.key == key:
+                return run
+        return None
+
+    def add(self, A_m2, q, W=None, label=None, key=None, meta=None, engine="auto"):
+        # A_m2/q pueden venir de CachedRun (sólo lectura, no se copian); W se calcula si falta
+        if W is not None:
+            W = np.asarray(W, dtype=np.float64).reshape(-1)
+            a, p = np.size(A_m2), np.size(q)
+            if W.size != a + p - 1:
+                raise ValueError(f"W tiene {W.size} horas; con a={a} y p={p} se esperaban {a + p - 1}.")
+        A_m2 = self._share(A_m2)
+        q = self._share(q)
+        if W is None:
+            W = compute_W(A_m2, q, engine=engine)
+        if W.flags.writeable:
+            W = W.copy()
+            W.setflags(write=False)
+        self._count += 1
+        if label is None:
+            label = f"Corrida {self._count}"
+        if label in self._runs:
+            self.remove(label)
+        run = self._runs[label] = StoredRun(label, key, A_m2, q, W, meta)
+        while len(self._runs) > self.max_runs:
+            self.remove(next(iter(self._runs)))
+        return run
+
+    def add_run(self, run, label=None, meta=None):
+        # run: CachedRun; si ya está guardada (misma clave) se devuelve la existente
+        old = self.find(run.key)
+        if old is not None:
+            return old
+        return self.add(run.A_m2, run.q, run.W, label=label, key=run.key, meta=meta)
+
+    def remove(self, label):
+        run = self._runs.pop(label)
+        self._release(run)
+        return run
+
+    def rename(self, label, new_label):
+        if new_label in self._runs:
+            raise ValueError(f"Ya existe una corrida llamada {new_label!r}.")
+        runs = [(new_label if k == label else k, r) for k, r in self._runs.items()]
+        self[label].label = new_label
+        self._runs.clear()
+        self._runs.update(runs)
+
+    def clear(self):
+        self._runs.clear()
+        self._arrays.clear()
+
+    def _select(self, labels):
+        return list(self._runs.values()) if labels is None else [self[l] for l in labels]
+
+    def hydrographs(self, labels=None, kind="flows"):
+        # matriz corridas × h_max; las corridas más cortas se completan con ceros (sin aporte)
+        runs = self._select(labels)
+        h = max((r.W.size for r in runs), default=0)
+        out = np.zeros((len(runs), h))
+        for i, r in enumerate(runs):
+            out[i, :r.W.size] = r.W
+        return out / 3600.0 if kind == "flows" else out
+
+    def compare(self, ref=None, labels=None):
+        # tabla contra la corrida de referencia (por defecto, la primera de la selección)
+        runs = self._select(labels)
+        if not runs:
+            raise ValueError("No hay corridas para comparar.")
+        base = runs[0] if ref is None else self[ref]
+        n = len(runs)
+        diff = np.zeros(n)
+        for i, r in enumerate(runs):
+            m = min(r.W.size, base.W.size)
+            d = np.abs(r.W[:m] - base.W[:m])
+            tail = r.W[m:] if r.W.size > m else base.W[m:]
+            diff[i] = max(d.max(initial=0.0), np.abs(tail).max(initial=0.0)) / 3600.0
+        peak = np.array([r.peak_flow for r in runs])
+        hour = np.array([r.peak_hour for r in runs])
+        vol = np.array([r.total_volume for r in runs])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            peak_ratio = peak / base.peak_flow
+            vol_ratio = vol / base.total_volume
+        return ComparisonTable(labels=[r.label for r in runs], ref=base.label,
+                               a=np.array([r.A_m2.size for r in runs]),
+                               p=np.array([r.q.size for r in runs]),
+                               h=np.array([r.W.size for r in runs]),
+                               peak_flow=peak, peak_hour=hour, volume=vol,
+                               d_peak=peak - base.peak_flow, peak_ratio=peak_ratio,
+                               d_peak_hour=hour - base.peak_hour, volume_ratio=vol_ratio,
+                               max_abs_diff=diff)
+
+class ComparisonTable:
+    # una fila por corrida; diferencias y razones respecto de la corrida ref
+    __slots__ = ("labels", "ref", "a", "p", "h", "peak_flow", "peak_hour", "volume", "d_peak",
+                 "peak_ratio", "d_peak_hour", "volume_ratio", "max_abs_diff")
+
+    def __init__(self, **kw):
+        for name in self.__slots__:
+            setattr(self, name, kw[name])
+
+    def __len__(self):
+        return len(self.labels)
+
+    def format(self):
+        lines = [f"Referencia: {self.ref}",
+                 f"{'corrida':<16} {'h':>7} {'pico(m³/s)':>11} {'hora':>6} {'Δpico':>10} "
+                 f"{'razón':>7} {'Δhora':>6} {'razón vol':>9} {'máx|ΔQ|':>10}"]
+        for i, lab in enumerate(self.labels):
+            lines.append(f"{lab[:16]:<16} {self.h[i]:>7} {self.peak_flow[i]:>11.4f} {self.peak_hour[i]:>6} "
+                         f"{self.d_peak[i]:>+10.4f} {self.peak_ratio[i]:>7.3f} {self.d_peak_hour[i]:>+6d} "
+                         f"{self.volume_ratio[i]:>9.3f} {self.max_abs_diff[i]:>10.4f}")
+        return "\n".join(lines)
+
+    def write_csv(self, path):
+        import csv
+        with open(path, "w", newline="") as fh:
+            wr = csv.writer(fh)
+            wr.writerow(COMPARE_COLUMNS)
+            for i, lab in enumerate(self.labels):
+                wr.writerow([lab, self.a[i], self.p[i], self.h[i], f"{self.peak_flow[i]:.6f}", self.peak_hour[i],
+                             f"{self.volume[i]:.6f}", f"{self.d_peak[i]:.6f}", f"{self.peak_ratio[i]:.6f}",
+                             self.d_peak_hour[i], f"{self.volume_ratio[i]:.6f}", f"{self.max_abs_diff[i]:.6f}"])
+
+def draw_run_overlay(fig, store, labels=None, graph_type="Caudal vs Hora", ref=None,
+                     max_points=RUNSTORE_PLOT_POINTS):
+    # una curva por corrida (o su diferencia con ref) en una sola LineCollection; las series
+    # largas se reducen a min/max por bloque para no dibujar millones de vértices
+    _load_plotting()
+    from matplotlib.collections import LineCollection
+    fig.clf()
+    ax = fig.add_subplot(111)
+    runs = store._select(labels)
+    caudal = graph_type.startswith("Caudal")
+    scale = 1 / 3600.0 if caudal else 1.0
+    base = None if ref is None else store[ref]
+    colors = plt.cm.tab20(np.arange(len(runs)) % 20)
+    segs = []
+    for r in runs:
+        y = r.W * scale
+        if base is not None:
+            b = base.W * scale
+            n = max(y.size, b.size)
+            y = np.pad(y, (0, n - y.size)) - np.pad(b, (0, n - b.size))
+        first, last, lo, hi = decimate_minmax(y, max_points // 2)
+        if lo is hi:
+            segs.append(np.column_stack([first, y]))
+        else:
+            # cada bloque aporta su mínimo y su máximo: la envolvente se ve igual que la serie
+            segs.append(np.column_stack([np.repeat((first + last) / 2.0, 2), np.column_stack([lo, hi]).reshape(-1)]))
+    ax.add_collection(LineCollection(segs, colors=colors, linewidths=1.2))
+    ax.autoscale_view()
+    if len(runs) <= 12:
+        from matplotlib.lines import Line2D
+        ax.legend([Line2D([], [], color=c) for c in colors], [r.label for r in runs], fontsize=8)
+    unit = "Caudal (m³/s)" if caudal else "Volumen (m³)"
+    ax.set_xlabel("Hora")
+    ax.set_ylabel(unit if base is None else f"Δ {unit} vs {base.label}")
+    ax.set_title(graph_type if base is None else f"Diferencia respecto de {base.label}")
+    if base is not None:
+        ax.axhline(0.0, color="#888", linewidth=0.8)
+    ax.grid(True, linestyle='--', alpha=0.4)
+    return ax
+
+# --------------------------
+# Simulación en segundo plano
+# --------------------------
+# Tramos de q en que compute_W_chunked parte la convolución (puntos de avance/cancelación)
+SIM_PROGRESS_STEPS = 50
+# Corridas con menos celdas (a·p) se resuelven directamente en el hilo de la interfaz
+SIM_BACKGROUND_MIN_CELLS = 200_000
+# Intervalo (ms) con que la interfaz lee los mensajes del hilo de trabajo
+SIM_POLL_MS = 50
+
+class SimulationCancelled(Exception):
+    pass
+
+def compute_W_chunked(A_m2, q_eff, engine="auto", progress=None, cancelled=None, steps=SIM_PROGRESS_STEPS):
+    # W por solapamiento-suma en `steps` tramos: entre tramos se informa el avance (0..1) y
+    # se consulta cancelled(). Se corta el vector más largo (la convolución es simétrica),
+    # así cada tramo cuesta una fracción parecida del total sea a >= p o p > a.
+    A = np.asarray(A_m2, dtype=float).reshape(-1)
+    q = np.asarray(q_eff, dtype=float).reshape(-1)
+    x, k = (A, q) if A.size >= q.size else (q, A)
+    n, m = x.size, k.size
+    W = np.zeros(n + m - 1)
+    step = max(1, -(-n // steps))
+    for i0 in range(0, n, step):
+        if cancelled is not None and cancelled():
+            raise SimulationCancelled()
+        i1 = min(n, i0 + step)
+        W[i0:i1 + m - 1] += compute_W(x[i0:i1], k, engine=engine)
+        if progress is not None:
+            progress(i1 / n)
+    return W
+
+class SimulationJob:
+    # Una corrida fuera del hilo de la interfaz. El hilo sólo calcula y deja mensajes
+    # ("progress", fracción), ("done", CachedRun), ("error", excepción) o ("cancelled", None)
+    # en una cola que la interfaz vacía con poll() desde root.after.
+    def __init__(self, key, areas_km2, P_mm, Ce, Cm, units_mm=True, engine="auto", timer=None):
+        import queue
+        import threading
+        self.key = key
+        # copias: el usuario puede editar las listas mientras el hilo trabaja
+        self.inputs = tuple(np.array(v, dtype=float).reshape(-1) for v in (areas_km2, P_mm, Ce, Cm))
+        self.units_mm = units_mm
+        self.engine = engine
+        self.timer = timer or StageTimer()
+        self.messages = queue.Queue()
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def run(self):
+        areas_km2, P_mm, Ce, Cm = self.inputs
+        try:
+            with self.timer.stage("q_eff"):
+                A_m2 = areas_km2 * 1e6
+                q = compute_effective_depth(P_mm, Ce, Cm, units_mm=self.units_mm)
+            with self.timer.stage("W"):
+                W = compute_W_chunked(A_m2, q, engine=self.engine, cancelled=self._cancel.is_set,
+                                      progress=lambda f: self.messages.put(("progress", f)))
+            self.messages.put(("done", CachedRun(self.key, A_m2, q, W)))
+        except SimulationCancelled:
+            self.messages.put(("cancelled", None))
+        except Exception as e:
+            self.messages.put(("error", e))
+
+    def start(self):
+        import threading
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def poll(self):
+        import queue
+        out = []
+        while True:
+            try:
+                out.append(self.messages.get_nowait())
+            except queue.Empty:
+                return out
+
 # --------------------------
 # Gráficos
 # --------------------------
 def draw_main_plot(fig, ax, W, flows, graph_type="Caudal vs Hora", style="Bar 2D"):
+    _load_plotting()
     fig.clf()
     if style == "Bar 3D" and HAS_3D:
         ax3 = fig.add_subplot(111, projection='3d')
@@ -98,7 +1882,307 @@ def draw_main_plot(fig, ax, W, flows, graph_type="Caudal vs Hora", style="Bar 2D
         ax2.grid(True, linestyle='--', alpha=0.4)
         return fig, ax2
 
+# --------------------------
+# Gráfico principal incremental
+# --------------------------
+# Con más de PLOT_LOD_FACTOR horas por píxel la serie se reduce a min/max por columna
+PLOT_LOD_FACTOR = 2
+# Máximo de barras del gráfico 3D (las horas se agrupan en bloques)
+PLOT_3D_MAX_BARS = 200
+
+def decimate_minmax(y, n_bins):
+    # bloques contiguos de horas: (primera hora, última hora, mínimo, máximo), horas base 1
+    y = np.asarray(y, dtype=float)
+    n = y.size
+    if n <= n_bins:
+        hours = np.arange(1, n + 1)
+        return hours, hours, y, y
+    edges = np.linspace(0, n, n_bins + 1).astype(int)
+    starts = edges[:-1]
+    return starts + 1, edges[1:], np.minimum.reduceat(y, starts), np.maximum.reduceat(y, starts)
+
+def render_bar3d_image(y, graph_type, width_px, height_px, dpi=100):
+    # figura Agg propia (no comparte estado con la GUI), por eso puede correr en otro hilo
+    _load_plotting()
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=(width_px / dpi, height_px / dpi), dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax3 = fig.add_subplot(111, projection='3d')
+    first, last, _, heights = decimate_minmax(y, PLOT_3D_MAX_BARS)
+    xs = first.astype(float)
+    zs = np.zeros_like(xs)
+    dx = (last - first + 1) * 0.5
+    dy = np.ones_like(xs) * 0.5
+    ax3.bar3d(xs, zs, np.zeros_like(heights), dx, dy, heights, shade=True)
+    ax3.set_xlabel("Hora")
+    ax3.set_title(graph_type)
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba()).copy()
+
+class MainPlotManager:
+    # Mantiene los artistas de cada (tipo de gráfico, estilo) y sólo actualiza sus datos.
+    # Las series largas se dibujan reducidas a min/max por píxel; la vista 3D se genera
+    # en un hilo aparte y se muestra como imagen cuando está lista (sondeo con `after`).
+    def __init__(self, fig, ax=None, after=None, redraw=None):
+        _load_plotting()
+        self.fig = fig
+        self.after = after
+        self.redraw = redraw or (lambda: fig.canvas.draw_idle())
+        self.ax2 = ax if ax is not None else fig.add_subplot(111)
+        self.ax_img = None
+        self.image = None
+        self.image_msg = None
+        self.artists = {}
+        self.W = self.flows = None
+        self.version = 0
+        self.current = None
+        self._img_cache = {}
+        self._job = None
+
+    def set_data(self, W, flows):
+        self.W = np.asarray(W, dtype=float)
+        self.flows = np.asarray(flows, dtype=float)
+        self.version += 1
+        self._img_cache.clear()
+
+    def _series(self, graph_type):
+        if graph_type.startswith("Caudal"):
+            return self.flows, "Caudal (m³/s)"
+        return self.W, "Volumen (m³)"
+
+    def _pixel_size(self):
+        w, h = self.fig.get_size_inches() * self.fig.dpi
+        return max(int(w), 1), max(int(h), 1)
+
+    def _activate(self, ax):
+        for other in (self.ax2, self.ax_img):
+            if other is not None:
+                other.set_visible(other is ax)
+
+    def _make_artists(self, style):
+        from matplotlib.collections import PolyCollection
+        ax = self.ax2
+        if style == "Line 2D":
+            line, = ax.plot([], [], marker='o', linestyle='-', color="#264653", linewidth=2)
+            fill = PolyCollection([], alpha=0.08, facecolor="#264653", edgecolor="none")
+            ax.add_collection(fill)
+            return {"kind": "line", "line": line, "fill": fill, "state": None}
+        bars = PolyCollection([], facecolor="#2a9d8f", edgecolor="none")
+        ax.add_collection(bars)
+        return {"kind": "bar", "bars": bars, "state": None}
+
+    def _set_2d(self, arts, y):
+        n_bins = max(1, int(self.ax2.bbox.width)) * PLOT_LOD_FACTOR
+        state = (self.version, min(n_bins, y.size))
+        if arts["state"] == state:
+            return
+        arts["state"] = state
+        first, last, ymin, ymax = decimate_minmax(y, n_bins)
+        if arts["kind"] == "bar":
+            # una barra por hora (ancho 0.8) o por bloque de horas si se reduce
+            x0 = first - 0.4
+            x1 = last + 0.4
+            y0 = np.minimum(ymin, 0.0)
+            y1 = np.maximum(ymax, 0.0)
+            verts = np.stack([np.stack([x0, y0], 1), np.stack([x0, y1], 1),
+                              np.stack([x1, y1], 1), np.stack([x1, y0], 1)], axis=1)
+            arts["bars"].set_verts(verts)
+        else:
+            if first.size == y.size:
+                xs, ys = first.astype(float), y
+                arts["line"].set_marker('o')
+            else:
+                mid = (first + last) / 2.0
+                xs, ys = np.repeat(mid, 2), np.stack([ymin, ymax], 1).reshape(-1)
+                arts["line"].set_marker('None')
+            arts["line"].set_data(xs, ys)
+            poly = np.concatenate([[[xs[0], 0.0]], np.stack([xs, ys], 1), [[xs[-1], 0.0]]])
+            arts["fill"].set_verts([poly])
+
+    def show(self, graph_type="Caudal vs Hora", style="Bar 2D", redraw=True):
+        if self.W is None:
+            return self.ax2
+        if style == "Bar 3D" and HAS_3D:
+            return self._show_3d(graph_type)
+        if style not in ("Bar 2D", "Line 2D"):
+            style = "Bar 2D"
+        key = (graph_type, style)
+        self.current = key
+        self._activate(self.ax2)
+        arts = self.artists.get(key)
+        if arts is None:
+            arts = self.artists[key] = self._make_artists(style)
+        for k, other in self.artists.items():
+            for name, art in other.items():
+                if name not in ("kind", "state"):
+                    art.set_visible(k == key)
+        y, ylabel = self._series(graph_type)
+        self._set_2d(arts, y)
+        ax = self.ax2
+        ax.set_xlim(0, y.size + 1)
+        lo, hi = min(0.0, float(y.min())), max(0.0, float(y.max()))
+        pad = (hi - lo) * 0.05 or 1.0
+        ax.set_ylim(lo - pad if lo < 0 else 0.0, hi + pad)
+        ax.set_xlabel("Hora")
+        ax.set_ylabel(ylabel)
+        ax.set_title(graph_type)
+        ax.grid(True, linestyle='--', alpha=0.4)
+        if redraw:
+            self.redraw()
+        return ax
+
+    def _show_image(self, img, msg=None):
+        if self.ax_img is None:
+            self.ax_img = self.fig.add_axes([0, 0, 1, 1])
+            self.ax_img.axis('off')
+            self.image_msg = self.ax_img.text(0.5, 0.5, "", ha='center', va='center',
+                                              transform=self.ax_img.transAxes)
+        self._activate(self.ax_img)
+        if img is not None:
+            if self.image is None:
+                self.image = self.ax_img.imshow(img, aspect='auto')
+            else:
+                self.image.set_data(img)
+                self.image.set_extent((-0.5, img.shape[1] - 0.5, img.shape[0] - 0.5, -0.5))
+            self.image.set_visible(True)
+        elif self.image is not None:
+            self.image.set_visible(False)
+        self.image_msg.set_text(msg or "")
+
+    def _show_3d(self, graph_type):
+        import queue
+        import threading
+        self.current = (graph_type, "Bar 3D")
+        w, h = self._pixel_size()
+        key = (graph_type, self.version, w, h)
+        img = self._img_cache.get(key)
+        if img is not None:
+            self._show_image(img)
+            self.redraw()
+            return self.ax_img
+        y, _ = self._series(graph_type)
+        if self.after is None:
+            self._img_cache[key] = render_bar3d_image(y, graph_type, w, h, dpi=self.fig.dpi)
+            return self._show_3d(graph_type)
+        self._show_image(None, "Generando vista 3D...")
+        self.redraw()
+        if self._job is None:
+            q = queue.Queue()
+
+            def work():
+                try:
+                    q.put((key, render_bar3d_image(y, graph_type, w, h, dpi=self.fig.dpi)))
+                except Exception as e:
+                    q.put((key, e))
+            threading.Thread(target=work, daemon=True).start()
+            self._job = q
+            self.after(40, self._poll)
+        return self.ax_img
+
+    def _poll(self):
+        import queue
+        try:
+            key, result = self._job.get_nowait()
+        except queue.Empty:
+            self.after(40, self._poll)
+            return
+        self._job = None
+        if isinstance(result, Exception):
+            if self.current is not None and self.current[1] == "Bar 3D":
+                self._show_image(None, f"No fue posible dibujar en estilo Bar 3D: {result}")
+                self.redraw()
+            return
+        if key[1] == self.version:
+            self._img_cache[key] = result
+        if self.current is not None and self.current[1] == "Bar 3D":
+            # muestra el resultado o lanza otro render si cambió el tipo, los datos o el tamaño
+            self._show_3d(self.current[0])
+
+# Por encima de este tamaño (h × a celdas) los aportes se calculan por hora en vez de precalcularse
+SIM_MAX_PRECOMPUTED_CELLS = 5_000_000
+# Ancho mínimo (fracción del esquema) para rotular un rectángulo; los más estrechos no se leen
+SIM_LABEL_MIN_WIDTH = 0.05
+
+def hour_contribution_matrix(V):
+    # C[k-1, i] = aporte del área i a W_k, para todas las horas de una vez
+    a, p = V.shape
+    C = np.zeros((a + p - 1, a))
+    if isinstance(V, FactoredV):
+        for i in range(a):
+            C[i:i + p, i] = V.A[i] * V.q
+    else:
+        V = np.asarray(V, dtype=float)
+        for i in range(a):
+            C[i:i + p, i] = V[i]
+    return C
+
+class WatershedScene:
+    # Esquema de la cuenca del simulador: la geometría (rectángulos, isócronas, salida)
+    # se crea una sola vez y cada hora sólo cambia colores y textos.
+    def __init__(self, ax, areas_km2, V_matrix, p, animated=False):
+        _load_plotting()
+        from matplotlib.collections import LineCollection, PatchCollection
+        self.ax = ax
+        self.V = V_matrix
+        self.areas_km2 = list(areas_km2)
+        a = len(self.areas_km2)
+        self.h = a + p - 1
+        if self.h * a <= SIM_MAX_PRECOMPUTED_CELLS:
+            self.C = hour_contribution_matrix(V_matrix)
+        else:
+            self.C = None
+        # draw topographic-like layout (stacked terraces)
+        total_width = 1.0
+        widths = np.array(self.areas_km2) / np.sum(self.areas_km2)
+        widths = np.clip(widths, 0.01, None)
+        widths = widths / widths.sum() * total_width
+        x = 0.02 + np.concatenate(([0.0], np.cumsum(widths + 0.01)[:-1]))
+        y = 0.1 + np.arange(a) * 0.02
+        # height to visualize area ranking (not hydrologic real altitude, just graphic)
+        heights = 0.12 + np.arange(a) * 0.02 + (0.6 / a) * (widths * 10)
+        rects = [plt.Rectangle((x[i], y[i]), widths[i], heights[i]) for i in range(a)]
+        self.patches = PatchCollection(rects, edgecolor='k', animated=animated)
+        ax.add_collection(self.patches)
+        self.label_idx = [i for i in range(a) if widths[i] >= SIM_LABEL_MIN_WIDTH]
+        self.labels = [ax.text(x[i] + widths[i]/2, y[i] + heights[i]/2, "",
+                               ha='center', va='center', fontsize=8, color='white', animated=animated)
+                       for i in self.label_idx]
+        # draw diagonal isochrones lines across the layout to illustrate travel times
+        iso = 0.05 + 0.9 * (np.arange(1, a + p) / (a + p))
+        segs = np.zeros((iso.size, 2, 2))
+        segs[:, 1, 0] = 1.0
+        segs[:, :, 1] = iso[:, None]
+        ax.add_collection(LineCollection(segs, colors="#888", linestyles="--", linewidths=0.6, alpha=0.6))
+        # draw exit arrow at right
+        ax.annotate("Salida", xy=(1.02, 0.5), xytext=(1.02, 0.8), arrowprops=dict(facecolor='black', shrink=0.05))
+        ax.axis('off')
+        ax.set_xlim(0, 1.1)
+        ax.set_ylim(0, 1)
+        self.title = ax.set_title(" ", animated=animated)
+
+    @property
+    def dynamic_artists(self):
+        return [self.patches, self.title] + self.labels
+
+    def contributions(self, k):
+        if self.C is not None:
+            return self.C[k - 1]
+        return hour_contributions(self.V, k)
+
+    def update(self, k):
+        contribs = self.contributions(k)
+        # normalize contributions for color
+        maxc = contribs.max() if contribs.max() > 0 else 1.0
+        norm = contribs / maxc
+        self.patches.set_facecolor(plt.cm.viridis(0.2 + 0.8 * norm))
+        for idx, txt in zip(self.label_idx, self.labels):
+            txt.set_text(f"A{idx+1}\n{self.areas_km2[idx]:.3f} km²\nV={contribs[idx]:.0f} m³")
+        self.title.set_text(f"Contribuciones a la hora {k} (W_k = {contribs.sum():.2f} m³)")
+        return self.dynamic_artists
+
 def open_watershed_simulator_realistic(root, areas_km2, V_matrix, p):
+    _load_gui()
     a = len(areas_km2)
     h = a + p - 1
     top = tk.Toplevel(root)
@@ -137,60 +2221,334 @@ def open_watershed_simulator_realistic(root, areas_km2, V_matrix, p):
     ttk.Label(legend, text="Rectángulos: sub-áreas (proporción de área)").pack(anchor="w", padx=6, pady=2)
     ttk.Label(legend, text="Color: aporte en la hora k").pack(anchor="w", padx=6, pady=2)
 
+    # aportes precalculados y artistas creados una vez; cada hora se redibuja con blitting
+    scene = WatershedScene(ax, areas_km2, V_matrix, p, animated=True)
+    state = {"bg": None, "k": 1, "pending": None}
+
+    def blit_dynamic():
+        for art in scene.dynamic_artists:
+            fig.draw_artist(art)
+        canvas.blit(fig.bbox)
+
+    def on_draw(event):
+        # fondo estático capturado tras cada redibujado completo (p. ej. al redimensionar)
+        state["bg"] = canvas.copy_from_bbox(fig.bbox)
+        blit_dynamic()
+
+    canvas.mpl_connect("draw_event", on_draw)
+
     def draw_for_hour(k):
-        ax.clear()
-        # compute contribution per area for W_k
-        contribs = np.zeros(a)
-        for i in range(a):
-            for j in range(p):
-                if (i + j + 1) == k:
-                    contribs[i] += V_matrix[i, j]
-        # normalize contributions for color
-        maxc = contribs.max() if contribs.max() > 0 else 1.0
-        norm = contribs / maxc
-        # draw topographic-like layout (stacked terraces)
-        total_width = 1.0
-        widths = np.array(areas_km2) / np.sum(areas_km2)
-        widths = np.clip(widths, 0.01, None)
-        widths = widths / widths.sum() * total_width
-        x = 0.02
-        y_base = 0.1
-        height_unit = 0.6 / a
-        for idx, w in enumerate(widths):
-            # height to visualize area ranking (not hydrologic real altitude, just graphic)
-            h_rect = 0.12 + idx * 0.02 + height_unit * (widths[idx] * 10)
-            rect = plt.Rectangle((x, y_base + idx * 0.02), w, h_rect,
-                                 facecolor=plt.cm.viridis(0.2 + 0.8 * norm[idx]),
-                                 edgecolor='k')
-            ax.add_patch(rect)
-            ax.text(x + w/2, y_base + idx * 0.02 + h_rect/2,
-                    f"A{idx+1}\n{areas_km2[idx]:.3f} km²\nV={contribs[idx]:.0f} m³",
-                    ha='center', va='center', fontsize=8, color='white')
-            x += w + 0.01
-        # draw diagonal isochrones lines across the layout to illustrate travel times
-        for iso in range(1, a + p):
-            ax.plot([0, 1], [0.05 + 0.9 * (iso / (a + p)), 0.05 + 0.9 * (iso / (a + p))],
-                    color="#888", linestyle="--", linewidth=0.6, alpha=0.6)
-        # draw exit arrow at right
-        ax.annotate("Salida", xy=(1.02, 0.5), xytext=(1.02, 0.8), arrowprops=dict(facecolor='black', shrink=0.05))
-        ax.axis('off')
-        ax.set_xlim(0, 1.1)
-        ax.set_ylim(0, 1)
-        ax.set_title(f"Contribuciones a la hora {k} (W_k = {contribs.sum():.2f} m³)")
-        canvas.draw()
+        scene.update(k)
+        if state["bg"] is None:
+            canvas.draw()
+            return
+        canvas.restore_region(state["bg"])
+        blit_dynamic()
 
-    draw_for_hour(1)
+    scene.update(1)
+    canvas.draw()
+
+    def flush_slide():
+        state["pending"] = None
+        draw_for_hour(state["k"])
 
     def on_slide(val):
-        k = int(float(val))
-        draw_for_hour(k)
+        # agrupa los eventos del slider: sólo se dibuja la última hora pedida
+        state["k"] = int(float(val))
+        if state["pending"] is None:
+            state["pending"] = top.after_idle(flush_slide)
 
     slider.config(command=on_slide)
 
+    export_state = {"thread": None, "done": 0, "error": None}
+    export_lbl = ttk.Label(ctrl, text="")
+
+    def poll_export():
+        th = export_state["thread"]
+        if not top.winfo_exists():
+            return
+        if th.is_alive():
+            export_lbl.config(text=f"Exportando... {export_state['done']}/{h} horas")
+            top.after(200, poll_export)
+            return
+        export_state["thread"] = None
+        export_btn.config(state="normal")
+        if export_state["error"] is not None:
+            export_lbl.config(text="")
+            messagebox.showerror("Error", f"No se pudo exportar la animación:\n{export_state['error']}", parent=top)
+        else:
+            export_lbl.config(text=f"Animación exportada ({h} horas)")
+
+    def export_animation():
+        path = filedialog.asksaveasfilename(parent=top, defaultextension=".gif",
+                                            filetypes=[("GIF animado", "*.gif"), ("Todos", "*.*")])
+        if not path:
+            return
+        import threading
+
+        def work():
+            try:
+                render_simulator_animation(areas_km2, V_matrix, p, path, use_pool=True,
+                                           progress=lambda n, total: export_state.update(done=n))
+            except Exception as e:
+                export_state["error"] = e
+
+        export_state.update(done=0, error=None, thread=threading.Thread(target=work, daemon=True))
+        export_btn.config(state="disabled")
+        export_state["thread"].start()
+        poll_export()
+
+    export_btn = ttk.Button(ctrl, text="Exportar animación (GIF)", command=export_animation)
+    export_btn.pack(fill="x", pady=(6, 0))
+    export_lbl.pack(anchor="w")
+
     ttk.Button(ctrl, text="Cerrar", command=top.destroy).pack(pady=6)
 
+# --------------------------
+# Animación sin pantalla
+# --------------------------
+# Misma figura que la ventana del simulador
+ANIM_FIGSIZE = (7, 4)
+ANIM_DPI = 100
+ANIM_FPS = 8
+# Horas por tarea enviada al pool
+ANIM_CHUNK = 32
+# Colores de la paleta fija del GIF tomados de viridis (el resto es una rampa de grises)
+ANIM_PALETTE_COLORS = 192
+
+# estado de cada proceso de trabajo: figura Agg, escena y fondo estático ya dibujados
+_anim_state = {}
+
+def _anim_palette():
+    # paleta común a todos los fotogramas: los colores no parpadean y el GIF lleva una sola tabla
+    from PIL import Image
+    _load_plotting()
+    vir = plt.cm.viridis(np.linspace(0.2, 1.0, ANIM_PALETTE_COLORS))[:, :3]
+    grey = np.linspace(0.0, 1.0, 256 - ANIM_PALETTE_COLORS)[:, None].repeat(3, axis=1)
+    pal = Image.new("P", (1, 1))
+    pal.putpalette((np.vstack([vir, grey]) * 255).round().astype(np.uint8).reshape(-1).tolist())
+    return pal
+
+def _anim_setup(areas_km2, V, p, figsize=ANIM_FIGSIZE, dpi=ANIM_DPI, gif=False):
+    # Agg directo (sin pyplot ni cambio de backend): sirve igual en un proceso de trabajo
+    # que dentro de la GUI
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=figsize, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    scene = WatershedScene(ax, areas_km2, V, p, animated=True)
+    # los artistas animados no entran en draw(): queda sólo la geometría estática
+    canvas.draw()
+    _anim_state.clear()
+    _anim_state.update(fig=fig, canvas=canvas, scene=scene, bg=canvas.copy_from_bbox(fig.bbox),
+                       palette=_anim_palette() if gif else None)
+
+def _anim_render(k):
+    st = _anim_state
+    fig, canvas = st["fig"], st["canvas"]
+    canvas.restore_region(st["bg"])
+    for art in st["scene"].update(k):
+        fig.draw_artist(art)
+    return canvas.buffer_rgba()
+
+def _anim_chunk(hours, frame_dir=None):
+    # con frame_dir escribe PNG y no devuelve píxeles; si no, devuelve los fotogramas
+    # ya cuantizados a la paleta fija (1 byte por píxel) para armar el GIF
+    from PIL import Image
+    w, h = _anim_state["canvas"].get_width_height()
+    out = []
+    for k in hours:
+        # el buffer RGBA de Agg se envuelve sin copiar; convert hace la única copia
+        img = Image.frombuffer("RGBA", (w, h), _anim_render(int(k)), "raw", "RGBA", 0, 1).convert("RGB")
+        if frame_dir is not None:
+            img.save(os.path.join(frame_dir, f"hora_{int(k):05d}.png"), compress_level=1)
+        else:
+            out.append(img.quantize(palette=_anim_state["palette"], dither=Image.Dither.NONE).tobytes())
+    return (w, h), out
+
+def render_simulator_animation(areas_km2, V, p, out, hours=None, workers=None, fps=ANIM_FPS,
+                               figsize=ANIM_FIGSIZE, dpi=ANIM_DPI, chunk=ANIM_CHUNK, progress=None,
+                               use_pool=None):
+    # Exporta el simulador hora a hora sin pantalla. out: archivo .gif o carpeta de PNG
+    # (hora_00001.png, ...). V densa o FactoredV; cada proceso arma la escena una vez.
+    # use_pool=True renderiza en procesos aparte aunque haya uno solo (p. ej. desde un
+    # hilo de la GUI, para no compartir matplotlib con Tk).
+    a = len(areas_km2)
+    h = a + p - 1
+    hours = np.arange(1, h + 1) if hours is None else np.asarray(hours, dtype=int).reshape(-1)
+    if hours.size == 0 or hours.min() < 1 or hours.max() > h:
+        raise ValueError(f"Las horas a animar deben estar entre 1 y {h}.")
+    gif = str(out).lower().endswith(".gif")
+    frame_dir = None if gif else out
+    if frame_dir is not None:
+        os.makedirs(frame_dir, exist_ok=True)
+    tasks = [hours[s:s + chunk] for s in range(0, hours.size, chunk)]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(tasks)))
+    if use_pool is None:
+        use_pool = workers > 1
+    setup = (areas_km2, V, p, figsize, dpi, gif)
+    frames = []
+    size = None
+    pool = None
+    futures = []
+    try:
+        if not use_pool:
+            _anim_setup(*setup)
+            results = (_anim_chunk(t, frame_dir) for t in tasks)
+        else:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # sin fork: el proceso que llama puede tener Tk abierto
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=_anim_setup, initargs=setup,
+                                       mp_context=multiprocessing.get_context(method))
+            # se leen en el orden de las horas, que es el de los fotogramas del GIF
+            futures = [pool.submit(_anim_chunk, t, frame_dir) for t in tasks]
+            results = (f.result() for f in futures)
+        n = 0
+        for t, (size, res) in zip(tasks, results):
+            frames.extend(res)
+            n += t.size
+            if progress is not None:
+                progress(n, hours.size)
+    finally:
+        if pool is not None:
+            _shutdown_pool(pool, futures)
+        _anim_state.clear()
+    if gif:
+        from PIL import Image
+        pal = _anim_palette()
+        imgs = []
+        for data in frames:
+            img = Image.frombytes("P", size, data)
+            img.putpalette(pal.getpalette())
+            imgs.append(img)
+        imgs[0].save(out, save_all=True, append_images=imgs[1:], duration=int(round(1000 / fps)),
+                     loop=0, optimize=False)
+    return hours.size
+
+# --------------------------
+# Panel de resultados
+# --------------------------
+# Horas por página del informe de texto
+RESULTS_PAGE_ROWS = 200
+# Las listas de entrada más largas se resumen (primeros ... últimos valores)
+RESULTS_MAX_LIST_ITEMS = 24
+
+def summarize_list(values, max_items=RESULTS_MAX_LIST_ITEMS):
+    vals = np.asarray(values, dtype=float).reshape(-1)
+    if vals.size <= max_items:
+        return str([float(v) for v in vals])
+    half = max_items // 2
+    head = ", ".join(repr(float(v)) for v in vals[:half])
+    tail = ", ".join(repr(float(v)) for v in vals[-half:])
+    return f"[{head}, ..., {tail}] ({vals.size} valores)"
+
+def results_page_count(h, page_rows=RESULTS_PAGE_ROWS):
+    return max(1, -(-h // page_rows))
+
+def format_results_report(areas_km2, P_mm, Ce, Cm, W, flows, page=0, page_rows=RESULTS_PAGE_ROWS):
+    # informe completo en un solo string: resumen de entradas, una página de horas y máximos
+    h = W.size
+    n_pages = results_page_count(h, page_rows)
+    page = min(max(int(page), 0), n_pages - 1)
+    s0, s1 = page * page_rows, min(h, (page + 1) * page_rows)
+    lines = [
+        "---- RESULTADOS ----",
+        f"Áreas (km²): {summarize_list(areas_km2)}",
+        f"Precipitaciones P (mm): {summarize_list(P_mm)}",
+        f"Coef Escorr. Ce: {summarize_list(Ce)}",
+        f"Coef Mezcla Cm: {summarize_list(Cm)}",
+        f"Duración (h) = a + p - 1 = {h}\n",
+        "Hora  |  Volumen (m³)     |  Caudal (m³/s)",
+    ]
+    lines += [f"{i+1:3d}   |  {W[i]:12.2f}  |  {flows[i]:10.4f}" for i in range(s0, s1)]
+    if n_pages > 1:
+        lines.append(f"... página {page+1}/{n_pages} (horas {s0+1}-{s1} de {h})")
+    max_idx = int(np.argmax(flows)); max_flow = flows[max_idx]
+    max_vol_idx = int(np.argmax(W)); max_vol = W[max_vol_idx]
+    lines.append("")
+    lines.append(f"Hora crítica (máx caudal): {max_idx+1} -> {max_flow:.4f} m³/s")
+    lines.append(f"Volumen máximo por hora: {max_vol:.2f} m³ en hora {max_vol_idx+1}")
+    return "\n".join(lines)
+
+class VirtualResultsTable:
+    # Treeview con un número fijo de filas que se rellenan desde los arreglos W/caudales
+    # según la posición del scroll: el coste no depende de la cantidad de horas.
+    def __init__(self, parent, height=6):
+        _load_gui()
+        self.frame = ttk.Frame(parent)
+        self.frame.columnconfigure(0, weight=1)
+        cols = ("hora", "volumen", "caudal")
+        self.tree = ttk.Treeview(self.frame, columns=cols, show="headings", height=height)
+        self.tree.heading("hora", text="Hora")
+        self.tree.heading("volumen", text="Volumen (m³)")
+        self.tree.heading("caudal", text="Caudal (m³/s)")
+        self.tree.column("hora", width=60, anchor="center")
+        self.tree.column("volumen", width=140, anchor="e")
+        self.tree.column("caudal", width=120, anchor="e")
+        self.tree.grid(row=0, column=0, sticky="nsew")
+        self.scroll = ttk.Scrollbar(self.frame, orient="vertical", command=self._on_scroll)
+        self.scroll.grid(row=0, column=1, sticky="ns")
+        self.rows = height
+        self.items = [self.tree.insert("", "end", values=("", "", "")) for _ in range(height)]
+        self.W = self.flows = None
+        self.first = 0
+        for seq, step in (("<Button-4>", -1), ("<Button-5>", 1), ("<Up>", -1), ("<Down>", 1),
+                          ("<Prior>", -height), ("<Next>", height)):
+            self.tree.bind(seq, lambda e, s=step: self.scroll_by(s) or "break")
+        self.tree.bind("<MouseWheel>", lambda e: self.scroll_by(-1 if e.delta > 0 else 1) or "break")
+        self._render()
+
+    @property
+    def size(self):
+        return 0 if self.W is None else self.W.size
+
+    def set_data(self, W, flows):
+        self.W = np.asarray(W)
+        self.flows = np.asarray(flows)
+        self.first = 0
+        self._render()
+
+    def clear(self):
+        self.W = self.flows = None
+        self.first = 0
+        self._render()
+
+    def scroll_to(self, first):
+        self.first = int(min(max(first, 0), max(self.size - self.rows, 0)))
+        self._render()
+
+    def scroll_by(self, n):
+        self.scroll_to(self.first + n)
+
+    def _on_scroll(self, *args):
+        if args[0] == "moveto":
+            self.scroll_to(round(float(args[1]) * self.size))
+        elif args[0] == "scroll":
+            n = int(args[1])
+            self.scroll_by(n * self.rows if args[2] == "pages" else n)
+
+    def _render(self):
+        n = self.size
+        for r, iid in enumerate(self.items):
+            idx = self.first + r
+            if idx < n:
+                self.tree.move(iid, "", r)
+                self.tree.item(iid, values=(idx+1, f"{self.W[idx]:.2f}", f"{self.flows[idx]:.4f}"))
+            else:
+                self.tree.detach(iid)
+        if n:
+            self.scroll.set(self.first / n, min(1.0, (self.first + self.rows) / n))
+        else:
+            self.scroll.set(0.0, 1.0)
+
 class SAHAppV3:
     def __init__(self, root):
+        _load_gui()
         self.root = root
         root.title("SAH - Volúmenes Pasantes ")
 
@@ -256,9 +2614,26 @@ class SAHAppV3:
         style_combo = ttk.Combobox(controls, textvariable=self.style_var, state="readonly", values=default_styles)
         style_combo.grid(row=6, column=1, sticky="w", pady=(6,0))
 
-        ttk.Button(controls, text="Simular", command=self.simulate).grid(row=8, column=0, columnspan=2, pady=(12,6), sticky="ew")
+        load_frame = ttk.Frame(controls)
+        load_frame.grid(row=7, column=0, columnspan=2, pady=(10,0), sticky="ew")
+        load_frame.columnconfigure((0, 1), weight=1)
+        ttk.Button(load_frame, text="Cargar áreas…", command=self.load_areas_file).grid(row=0, column=0, sticky="ew", padx=(0,2))
+        ttk.Button(load_frame, text="Cargar lluvia…", command=self.load_storm_file).grid(row=0, column=1, sticky="ew", padx=(2,0))
+
+        run_frame = ttk.Frame(controls)
+        run_frame.grid(row=8, column=0, columnspan=2, pady=(12,6), sticky="ew")
+        run_frame.columnconfigure(0, weight=1)
+        ttk.Button(run_frame, text="Simular", command=self.simulate).grid(row=0, column=0, sticky="ew")
+        self.cancel_btn = ttk.Button(run_frame, text="Cancelar", state="disabled", command=self.cancel_simulation)
+        self.cancel_btn.grid(row=0, column=1, sticky="ew", padx=(4,0))
+        self.progress_var = tk.DoubleVar(value=0.0)
+        ttk.Progressbar(run_frame, variable=self.progress_var, maximum=100.0).grid(row=1, column=0, columnspan=2, sticky="ew", pady=(4,0))
         ttk.Button(controls, text="Mostrar resultados en ventana", command=self.open_results_window).grid(row=9, column=0, columnspan=2, sticky="ew")
         ttk.Button(controls, text="Abrir simulador cuenca", command=self.open_simulator).grid(row=10, column=0, columnspan=2, pady=(6,0), sticky="ew")
+        self.profile_next_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(controls, text="Perfilar próxima simulación", variable=self.profile_next_var).grid(row=11, column=0, columnspan=2, pady=(6,0), sticky="w")
+        ttk.Button(controls, text="Exportar tiempos (JSONL)", command=self.export_traces_dialog).grid(row=12, column=0, columnspan=2, pady=(6,0), sticky="ew")
+        ttk.Button(controls, text="Comparar corridas…", command=self.open_compare_window).grid(row=13, column=0, columnspan=2, pady=(6,0), sticky="ew")
 
         # bind traces to auto-update plot on combobox change
         self.graph_type_var.trace_add("write", lambda *a: self._on_style_change())
@@ -275,6 +2650,10 @@ class SAHAppV3:
         self.ax_main = self.fig_main.add_subplot(111)
         self.canvas_main = FigureCanvasTkAgg(self.fig_main, master=right)
         self.canvas_main.get_tk_widget().grid(row=0, column=0, sticky="nsew", padx=4, pady=4)
+        # artistas reutilizados entre simulaciones y cambios de estilo
+        self.plot_mgr = MainPlotManager(self.fig_main, self.ax_main, after=root.after,
+                                        redraw=self.canvas_main.draw_idle)
+        self.canvas_main.mpl_connect("resize_event", lambda e: self._update_main_plot())
 
         # results panel (embedded)
         results_frame = ttk.LabelFrame(right, text="Resultados")
@@ -285,21 +2664,33 @@ class SAHAppV3:
         self.txt = scrolledtext.ScrolledText(results_frame, width=60, height=8, state="disabled", wrap="none")
         self.txt.grid(row=0, column=0, sticky="nsew", padx=4, pady=4)
 
-        # table small (treeview)
-        cols = ("hora", "volumen", "caudal")
-        self.tree = ttk.Treeview(results_frame, columns=cols, show="headings", height=6)
-        self.tree.heading("hora", text="Hora")
-        self.tree.heading("volumen", text="Volumen (m³)")
-        self.tree.heading("caudal", text="Caudal (m³/s)")
-        self.tree.column("hora", width=60, anchor="center")
-        self.tree.column("volumen", width=140, anchor="e")
-        self.tree.column("caudal", width=120, anchor="e")
-        self.tree.grid(row=1, column=0, sticky="nsew", padx=4, pady=4)
+        # table small (treeview virtual: sólo las filas visibles)
+        self.table = VirtualResultsTable(results_frame, height=6)
+        self.table.frame.grid(row=1, column=0, sticky="nsew", padx=4, pady=4)
+        self.tree = self.table.tree
 
-        # export button
+        # export button + paginado del informe
         btn_frame = ttk.Frame(results_frame)
         btn_frame.grid(row=2, column=0, sticky="e", padx=6, pady=(0,6))
         ttk.Button(btn_frame, text="Exportar CSV", command=self.export_csv).pack(side="right")
+        self.page_next_btn = ttk.Button(btn_frame, text="▶", width=3, state="disabled",
+                                        command=lambda: self.show_results_page(self.results_page + 1))
+        self.page_next_btn.pack(side="right", padx=(0, 8))
+        self.page_lbl = ttk.Label(btn_frame, text="")
+        self.page_lbl.pack(side="right", padx=4)
+        self.page_prev_btn = ttk.Button(btn_frame, text="◀", width=3, state="disabled",
+                                        command=lambda: self.show_results_page(self.results_page - 1))
+        self.page_prev_btn.pack(side="right")
+        self.results_page = 0
+
+        # caché de corridas (mismas entradas -> resultado inmediato)
+        self.cache = SimulationCache()
+        # trazas de tiempos por corrida (ver export_traces y la variable SAH_TRACE)
+        self.traces = []
+        # corridas de la sesión para comparar escenarios (comparten áreas y láminas)
+        self.runs = RunStore()
+        # corrida en segundo plano en curso (SimulationJob); sólo se muestra la más reciente
+        self._job = None
 
         # store last results
         self.last_W = None
@@ -307,6 +2698,8 @@ class SAHAppV3:
         self.last_V = None
         self.last_p = None
         self.last_a = None
+        # entradas con que se calcularon last_* (las listas editables pueden cambiar después)
+        self.last_inputs = None
 
         # initial greeting (use helper so text area stays read-only to user)
         self.print_line("Interfaz lista. Configure parámetros y pulse 'Simular'. Cambios en 'Tipo/Estilo' actualizan el gráfico automáticamente.")
@@ -321,9 +2714,24 @@ class SAHAppV3:
     def clear_results_display(self):
         self.txt.config(state="normal")
         self.txt.delete("1.0", tk.END)
-        for r in self.tree.get_children():
-            self.tree.delete(r)
+        self.table.clear()
+        self.txt.config(state="disabled")
+
+    def show_results_page(self, page):
+        # reemplaza el informe de una vez (un solo insert) con la página pedida
+        if self.last_W is None:
+            return
+        n_pages = results_page_count(self.last_W.size)
+        self.results_page = min(max(page, 0), n_pages - 1)
+        report = format_results_report(*self.last_inputs, self.last_W, self.last_flows, page=self.results_page)
+        self.txt.config(state="normal")
+        self.txt.delete("1.0", tk.END)
+        self.txt.insert("1.0", report + "\n")
+        self.txt.see("1.0")
         self.txt.config(state="disabled")
+        self.page_lbl.config(text=f"Página {self.results_page+1}/{n_pages}" if n_pages > 1 else "")
+        self.page_prev_btn.config(state="normal" if self.results_page > 0 else "disabled")
+        self.page_next_btn.config(state="normal" if self.results_page < n_pages - 1 else "disabled")
 
     # editors (mismos comportamientos)
     def edit_areas(self):
@@ -374,6 +2782,10 @@ class SAHAppV3:
         except:
             messagebox.showerror("Error", "Cantidad de precipitaciones (p) debe ser entero positivo.")
             return
+        if p > PRECIP_EDITOR_MAX_ROWS:
+            messagebox.showinfo("Info", f"p={p} es demasiado grande para el editor (máx. {PRECIP_EDITOR_MAX_ROWS} horas).\n"
+                                        "Use 'Cargar lluvia…' para leer la serie desde un archivo.")
+            return
         while len(self.precips_mm) < p:
             self.precips_mm.append(0.0)
             self.ce.append(0.5)
@@ -414,6 +2826,33 @@ class SAHAppV3:
             top.destroy()
         ttk.Button(top, text="Guardar", command=save).pack(pady=6)
 
+    # carga desde archivo (sin un widget por valor)
+    def load_areas_file(self):
+        f = filedialog.askopenfilename(filetypes=LOAD_FILETYPES)
+        if not f:
+            return
+        try:
+            areas = load_areas(f)
+        except Exception as e:
+            messagebox.showerror("Error", f"No se pudo leer {f}: {e}")
+            return
+        self.areas_km2 = areas.tolist()
+        self.a_var.set(len(self.areas_km2))
+        self.print_line(f"Áreas cargadas de {f} (a={len(self.areas_km2)}): {summarize_list(self.areas_km2)}")
+
+    def load_storm_file(self):
+        f = filedialog.askopenfilename(filetypes=LOAD_FILETYPES)
+        if not f:
+            return
+        try:
+            P, Ce, Cm = load_storm(f)
+        except Exception as e:
+            messagebox.showerror("Error", f"No se pudo leer {f}: {e}")
+            return
+        self.precips_mm, self.ce, self.cm = P.tolist(), Ce.tolist(), Cm.tolist()
+        self.p_var.set(len(self.precips_mm))
+        self.print_line(f"Precipitaciones cargadas de {f} (p={len(self.precips_mm)}): P(mm)={summarize_list(self.precips_mm)}")
+
     # -------------------------
     # Simulación y UI updates
     # -------------------------
@@ -437,56 +2876,132 @@ class SAHAppV3:
             self.precips_mm.append(0.0); self.ce.append(0.5); self.cm.append(1.0)
         self.precips_mm = self.precips_mm[:p]; self.ce = self.ce[:p]; self.cm = self.cm[:p]
 
-        A_m2 = [v * 1e6 for v in self.areas_km2]
+        if self._job is not None:
+            # la corrida anterior queda reemplazada: se detiene y su resultado se descarta
+            self._job.cancel()
+            self._job = None
+            self._set_running(False)
+        timer = StageTimer(a=a, p=p)
+        capture = None
+        if self.profile_next_var.get():
+            import time
+            self.profile_next_var.set(False)
+            capture = ProfileCapture(os.path.abspath(time.strftime("sah_profile_%Y%m%d_%H%M%S")))
+            capture.__enter__()
         try:
-            Y = compute_Y_from_hour_vectors(self.ce, self.cm, a)
-            Q = compute_Q(self.precips_mm, Y, units_mm=True)
-            V = compute_V(A_m2, Q)
-            W = compute_W_from_V(V)
-            flows = W / 3600.0
-        except Exception as e:
-            messagebox.showerror("Error en cálculo", str(e))
+            with timer.stage("cache"):
+                key = simulation_key(self.areas_km2, self.precips_mm, self.ce, self.cm, units_mm=True)
+                run = self.cache.get(key)
+            if run is not None:
+                self._show_run(run, (list(self.areas_km2), list(self.precips_mm), list(self.ce), list(self.cm)), timer)
+                return
+            self.cache.misses += 1
+            job = SimulationJob(key, self.areas_km2, self.precips_mm, self.ce, self.cm, timer=timer)
+            if capture is None and a * p >= SIM_BACKGROUND_MIN_CELLS:
+                # corrida grande: la ventana sigue respondiendo y se puede cancelar
+                self._job = job.start()
+                self._set_running(True)
+                self.root.after(SIM_POLL_MS, self._poll_job, job)
+                return
+            # corrida chica (o perfilada): en este hilo, sin pasar por root.after
+            job.run()
+            for kind, value in job.poll():
+                if kind != "progress":
+                    self._finish_job(job, kind, value)
+        finally:
+            if capture is not None:
+                capture.__exit__(None, None, None)
+                self.print_line(f"Perfil guardado en {capture.prefix}.prof / .txt")
+
+    def cancel_simulation(self):
+        if self._job is None:
+            return
+        self._job.cancel()
+        self._job = None
+        self._set_running(False)
+        self.print_line("Simulación cancelada.")
+
+    def _set_running(self, running):
+        self.cancel_btn.config(state="normal" if running else "disabled")
+        self.progress_var.set(0.0)
+
+    def _poll_job(self, job):
+        if job is not self._job:
+            # cancelada o reemplazada por otra corrida: lo que produzca se ignora
+            return
+        for kind, value in job.poll():
+            if kind == "progress":
+                self.progress_var.set(100.0 * value)
+                continue
+            self._job = None
+            self._set_running(False)
+            self._finish_job(job, kind, value)
             return
+        self.root.after(SIM_POLL_MS, self._poll_job, job)
+
+    def _finish_job(self, job, kind, value):
+        if kind == "done":
+            self._show_run(self.cache.put(value), tuple(v.tolist() for v in job.inputs), job.timer)
+        elif kind == "error":
+            messagebox.showerror("Error en cálculo", str(value))
+
+    def _show_run(self, run, inputs, timer):
+        a, p = run.A_m2.size, run.q.size
+        V, W, flows = run.V, run.W, run.flows
 
         # store last
+        self.last_inputs = inputs
         self.last_W = W
         self.last_flows = flows
         self.last_V = V
         self.last_p = p
         self.last_a = a
+        self.runs.add_run(run)
 
         # update results panel embedded (using read-only helpers)
-        self.clear_results_display()
-        h = a + p - 1
-        self.print_line("---- RESULTADOS ----")
-        self.print_line(f"Áreas (km²): {self.areas_km2}")
-        self.print_line(f"Precipitaciones P (mm): {self.precips_mm}")
-        self.print_line(f"Coef Escorr. Ce: {self.ce}")
-        self.print_line(f"Coef Mezcla Cm: {self.cm}")
-        self.print_line(f"Duración (h) = a + p - 1 = {h}\n")
-        self.print_line("Hora  |  Volumen (m³)     |  Caudal (m³/s)")
-        for idx in range(h):
-            self.print_line(f"{idx+1:3d}   |  {W[idx]:12.2f}  |  {flows[idx]:10.4f}")
-            self.tree.insert("", "end", values=(idx+1, f"{W[idx]:.2f}", f"{flows[idx]:.4f}"))
-        max_idx = int(np.argmax(flows)); max_flow = flows[max_idx]
-        max_vol_idx = int(np.argmax(W)); max_vol = W[max_vol_idx]
-        self.print_line("")
-        self.print_line(f"Hora crítica (máx caudal): {max_idx+1} -> {max_flow:.4f} m³/s")
-        self.print_line(f"Volumen máximo por hora: {max_vol:.2f} m³ en hora {max_vol_idx+1}")
+        with timer.stage("panel"):
+            self.clear_results_display()
+            self.show_results_page(0)
+            self.table.set_data(W, flows)
 
         # update main plot (immediately)
-        self._update_main_plot()
+        with timer.stage("grafico"):
+            self.plot_mgr.set_data(W, flows)
+            self._update_main_plot(redraw=False)
+        with timer.stage("canvas.draw"):
+            self.canvas_main.draw()
+
+        self.traces.append(timer.to_dict())
+        self.print_line("")
+        self.print_line(timer.summary())
+        trace_path = os.environ.get(TRACE_ENV)
+        if trace_path:
+            timer.export_jsonl(trace_path)
+
+    def export_traces_dialog(self):
+        if not self.traces:
+            messagebox.showinfo("Info", "No hay tiempos registrados. Ejecuta Simular primero.")
+            return
+        f = filedialog.asksaveasfilename(defaultextension=".jsonl", filetypes=[("JSON lines", ".jsonl")])
+        if not f:
+            return
+        self.export_traces(f)
+        messagebox.showinfo("Exportado", f"Tiempos guardados en: {f}")
+
+    def export_traces(self, path):
+        # trazas de todas las corridas de la sesión, una por línea (JSON)
+        import json
+        with open(path, "w", encoding="utf-8") as fh:
+            for rec in self.traces:
+                fh.write(json.dumps(rec) + "\n")
 
-    def _update_main_plot(self):
+    def _update_main_plot(self, redraw=True):
         if self.last_W is None or self.last_flows is None:
             return
         graph_type = self.graph_type_var.get()
         style = self.style_var.get()
         try:
-            self.fig_main, self.ax_main = draw_main_plot(self.fig_main, self.ax_main,
-                                                         self.last_W, self.last_flows,
-                                                         graph_type=graph_type, style=style)
-            self.canvas_main.draw()
+            self.ax_main = self.plot_mgr.show(graph_type=graph_type, style=style, redraw=redraw)
         except Exception as e:
             messagebox.showwarning("Aviso gráfico", f"No fue posible dibujar en estilo {style}: {e}")
 
@@ -494,11 +3009,96 @@ class SAHAppV3:
         # auto-update chart when style or graph type changes
         self._update_main_plot()
 
+    def open_compare_window(self):
+        if not len(self.runs):
+            messagebox.showinfo("Info", "Ejecuta 'Simular' al menos una vez para tener corridas que comparar.")
+            return
+        top = tk.Toplevel(self.root)
+        top.title("Comparar corridas")
+        frm = ttk.Frame(top, padding=8)
+        frm.pack(fill="both", expand=True)
+        frm.columnconfigure(1, weight=1)
+        frm.rowconfigure(0, weight=1)
+
+        side = ttk.Frame(frm)
+        side.grid(row=0, column=0, sticky="ns", padx=(0, 6))
+        ttk.Label(side, text="Corridas:").pack(anchor="w")
+        lst = tk.Listbox(side, selectmode="extended", height=14, exportselection=False)
+        lst.pack(fill="y", expand=True)
+        ttk.Label(side, text="Referencia:").pack(anchor="w", pady=(6, 0))
+        ref_var = tk.StringVar()
+        ref_combo = ttk.Combobox(side, textvariable=ref_var, state="readonly")
+        ref_combo.pack(fill="x")
+
+        fig = plt.Figure(figsize=(7, 4), dpi=100)
+        canvas = FigureCanvasTkAgg(fig, master=frm)
+        canvas.get_tk_widget().grid(row=0, column=1, sticky="nsew")
+        txt = scrolledtext.ScrolledText(frm, width=100, height=8, state="disabled", wrap="none")
+        txt.grid(row=1, column=0, columnspan=2, sticky="ew", pady=(6, 0))
+
+        def refresh():
+            labels = self.runs.labels
+            lst.delete(0, tk.END)
+            for lab in labels:
+                r = self.runs[lab]
+                lst.insert(tk.END, f"{lab}  (a={r.shape[0]}, p={r.shape[1]})")
+            ref_combo.config(values=labels)
+            if ref_var.get() not in labels:
+                ref_var.set(labels[0] if labels else "")
+            lst.selection_set(0, tk.END)
+
+        def selected():
+            labels = self.runs.labels
+            sel = [labels[i] for i in lst.curselection()]
+            if not sel:
+                messagebox.showinfo("Info", "Selecciona al menos una corrida.", parent=top)
+            return sel
+
+        def show(diff):
+            sel = selected()
+            if not sel:
+                return
+            ref = ref_var.get() or None
+            draw_run_overlay(fig, self.runs, sel, graph_type=self.graph_type_var.get(), ref=ref if diff else None)
+            canvas.draw_idle()
+            txt.config(state="normal")
+            txt.delete("1.0", tk.END)
+            txt.insert("1.0", self.runs.compare(ref=ref, labels=sel).format())
+            txt.config(state="disabled")
+
+        def remove():
+            sel = selected()
+            for lab in sel:
+                self.runs.remove(lab)
+            refresh()
+            if len(self.runs):
+                show(False)
+            else:
+                fig.clf()
+                canvas.draw_idle()
+
+        def export_table():
+            sel = selected()
+            if not sel:
+                return
+            f = filedialog.asksaveasfilename(parent=top, defaultextension=".csv", filetypes=[("CSV", "*.csv")])
+            if not f:
+                return
+            self.runs.compare(ref=ref_var.get() or None, labels=sel).write_csv(f)
+            messagebox.showinfo("Exportado", f"Tabla guardada en: {f}", parent=top)
+
+        ttk.Button(side, text="Superponer", command=lambda: show(False)).pack(fill="x", pady=(8, 0))
+        ttk.Button(side, text="Diferencias vs referencia", command=lambda: show(True)).pack(fill="x", pady=(4, 0))
+        ttk.Button(side, text="Exportar tabla (CSV)", command=export_table).pack(fill="x", pady=(4, 0))
+        ttk.Button(side, text="Quitar seleccionadas", command=remove).pack(fill="x", pady=(4, 0))
+        refresh()
+        show(False)
+
     def open_simulator(self):
         if self.last_V is None:
             messagebox.showinfo("Info", "Ejecuta primero 'Simular' para generar datos y luego abre el simulador.")
             return
-        open_watershed_simulator_realistic(self.root, self.areas_km2, self.last_V, self.last_p)
+        open_watershed_simulator_realistic(self.root, self.last_inputs[0], self.last_V, self.last_p)
 
     def open_results_window(self):
         if self.last_W is None:
@@ -516,31 +3116,29 @@ class SAHAppV3:
         txt.config(state="disabled")
         # add copy/export
         def save_local():
-            f = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV", ".csv")])
+            f = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=EXPORT_FILETYPES)
             if not f:
                 return
             self._export_csv_to(f)
-            messagebox.showinfo("Exportado", f"CSV guardado en: {f}")
+            messagebox.showinfo("Exportado", f"Resultados guardados en: {f}")
         ttk.Button(frm, text="Exportar CSV", command=save_local).pack(side="right", padx=6, pady=6)
 
     def export_csv(self):
         if self.last_W is None or self.last_flows is None:
             messagebox.showinfo("Info", "No hay resultados para exportar. Ejecuta Simular primero.")
             return
-        f = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV", ".csv")])
+        f = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=EXPORT_FILETYPES)
         if not f:
             return
         self._export_csv_to(f)
-        messagebox.showinfo("Exportado", f"CSV guardado en: {f}")
+        messagebox.showinfo("Exportado", f"Resultados guardados en: {f}")
 
     def _export_csv_to(self, filepath):
-        import csv
-        h = self.last_W.size
-        with open(filepath, "w", newline="") as fh:
-            w = csv.writer(fh)
-            w.writerow(["Hora", "Volumen_m3", "Caudal_m3s"])
-            for i in range(h):
-                w.writerow([i+1, f"{self.last_W[i]:.6f}", f"{self.last_flows[i]:.6f}"])
+        if filepath.lower().endswith(".npz"):
+            meta = {"areas_km2": [float(v) for v in self.last_inputs[0]], "a": self.last_a, "p": self.last_p}
+            export_results_npz(filepath, self.last_W, self.last_flows, V=self.last_V, meta=meta)
+            return
+        write_results_csv(filepath, self.last_W, self.last_flows)
 
     def open_theory(self):
         top = tk.Toplevel(self.root)
@@ -568,14 +3166,1121 @@ class SAHAppV3:
         txt.config(state="disabled")
         ttk.Button(frm, text="Cerrar", command=top.destroy).pack(pady=6)
 
+# --------------------------
+# Carga de datos (series y áreas)
+# --------------------------
+# Ce/Cm por defecto cuando la serie sólo trae P (mismos valores que el editor)
+DEFAULT_CE = 0.5
+DEFAULT_CM = 1.0
+# Horas máximas del editor de precipitaciones (3 Entry por hora); series más largas se cargan de archivo
+PRECIP_EDITOR_MAX_ROWS = 500
+# Tipos de archivo de los diálogos "Cargar…"
+LOAD_FILETYPES = [("Tablas", ".csv .txt .npy .npz .raw"), ("Todos", "*")]
+# Factores a mm y a km² según las unidades declaradas
+P_UNITS = {"mm": 1.0, "m": 1000.0}
+AREA_UNITS = {"km2": 1.0, "m2": 1e-6, "ha": 1e-2}
+# Anotaciones de unidad aceptadas en las cabeceras, p. ej. "Area (ha)" o "P [mm/h]"
+AREA_UNIT_NAMES = {"km2": "km2", "m2": "m2", "ha": "ha", "hectareas": "ha"}
+P_UNIT_NAMES = {"mm": "mm", "m": "m", "mm/h": "mm", "m/h": "m"}
+
+def _read_table(path, vector=False):
+    # tabla numérica -> (datos 2-D, nombres de columna o None, meta). Con vector=True una única
+    # línea sin cabecera ('1 2 3') es un vector escrito en fila y se devuelve como columna; una
+    # tabla de una sola fila con varias columnas necesita entonces cabecera.
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".npy":
+        data = np.load(path, mmap_mode="r")
+        return (data.reshape(-1, 1) if data.ndim == 1 else data), None, {}
+    with open(path, "rb") as fh:
+        raw = fh.read(len(RAW_MAGIC)) == RAW_MAGIC
+    if raw:
+        data, meta = read_raw(path)
+        names = meta.get("columns")
+        return (data.reshape(-1, 1) if data.ndim == 1 else data), names, meta
+    # texto: separador ',', ';', tabulador o espacios; cabecera opcional
+    with open(path, "r", encoding="utf-8-sig") as fh:
+        first = fh.readline()
+    delim = next((d for d in (";", ",", "\t") if d in first), None)
+    if delim is None:
+        # separado por espacios: una unidad anotada ('Area (ha)') sigue perteneciendo a su columna
+        import re
+        tokens = re.findall(r"[^\s(\[]+(?:\s*[(\[][^)\]]*[)\]])?|[(\[][^)\]]*[)\]]", first)
+    else:
+        tokens = [t.strip() for t in first.split(delim) if t.strip()]
+    try:
+        [float(t) for t in tokens]
+        names, skip = None, 0
+    except ValueError:
+        names, skip = tokens, 1
+    data = np.loadtxt(path, delimiter=delim, skiprows=skip, ndmin=2, encoding="utf-8-sig")
+    if vector and names is None and data.shape[0] == 1:
+        data = data.reshape(-1, 1)
+    return data, names, {}
+
+def _norm_name(name):
+    return str(name).strip().lower().replace("á", "a").replace("ó", "o").replace(" ", "_")
+
+def _unit_token(name):
+    # unidad entre paréntesis o corchetes al final de la cabecera: 'Area (ha)' -> 'ha',
+    # 'P [mm]' -> 'mm'; None si la cabecera no trae anotación
+    import re
+    m = re.search(r"[(\[]([^()\[\]]*)[)\]]\s*$", str(name))
+    if m is None:
+        return None
+    return m.group(1).strip().lower().replace("²", "2").replace("^", "").replace("á", "a").replace(" ", "")
+
+def _header_units(path, name, known, what):
+    tok = _unit_token(name)
+    if tok is None:
+        return None
+    if tok not in known:
+        raise ValueError(f"{path}: unidad de {what} desconocida en la cabecera {name!r} "
+                         f"(opciones: {', '.join(known)}).")
+    return known[tok]
+
+def _check_finite(name, arr, path, nonneg=False):
+    if not np.all(np.isfinite(arr)):
+        raise ValueError(f"{path}: {name} contiene valores no numéricos o infinitos.")
+    if nonneg and np.any(arr < 0):
+        raise ValueError(f"{path}: {name} contiene valores negativos.")
+
+def load_areas(path, units=None):
+    # áreas en km²; columna 'area...' si hay cabecera (si no, la primera). Las unidades
+    # se toman de `units` o del nombre de la columna ('Area (ha)', 'area_m2', …km2).
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".npz":
+        with np.load(path) as z:
+            key = next((k for k in ("areas_km2", "areas", "A_km2", "A_m2") if k in z.files), None)
+            if key is None:
+                raise ValueError(f"{path}: no contiene 'areas_km2'.")
+            areas, names = np.asarray(z[key], dtype=float).reshape(-1), [key]
+        col = 0
+    else:
+        data, names, _ = _read_table(path, vector=True)
+        col = 0
+        if names:
+            norm = [_norm_name(n) for n in names]
+            col = next((k for k, n in enumerate(norm) if n.startswith("area") or n.startswith("a_")), 0)
+        areas = np.asarray(data[:, col], dtype=float)
+    if units is None and names:
+        units = _header_units(path, names[col], AREA_UNIT_NAMES, "área")
+    if units is None:
+        name = _norm_name(names[col]) if names else ""
+        units = "m2" if name.endswith(("m2", "m²")) and not name.endswith(("km2", "km²")) else \
+                "ha" if name.endswith("ha") else "km2"
+    if units not in AREA_UNITS:
+        raise ValueError(f"Unidades de área desconocidas: {units!r} (opciones: {', '.join(AREA_UNITS)}).")
+    if areas.size == 0:
+        raise ValueError(f"{path}: no contiene datos.")
+    _check_finite("el área", areas, path, nonneg=True)
+    return areas * AREA_UNITS[units]
+
+def load_storm(path, units=None):
+    # serie horaria -> (P en mm, Ce, Cm). Columnas P[, Ce[, Cm]] por posición o por nombre
+    # (p…/precip…/lluvia…, ce…, cm…); las que falten toman DEFAULT_CE / DEFAULT_CM.
+    ext = os.path.splitext(path)[1].lower()
+    cols = {}
+    if ext == ".npz":
+        with np.load(path) as z:
+            for key, names in (("P", ("P", "P_mm", "P_m", "precips_mm", "p")), ("Ce", ("Ce", "ce")),
+                               ("Cm", ("Cm", "cm"))):
+                k = next((n for n in names if n in z.files), None)
+                if k is not None:
+                    cols[key] = (np.asarray(z[k], dtype=float).reshape(-1), k)
+        if "P" not in cols:
+            raise ValueError(f"{path}: no contiene la serie 'P'.")
+    else:
+        data, names, _ = _read_table(path)
+        if names:
+            for k, name in enumerate(_norm_name(n) for n in names):
+                key = "Ce" if name.startswith("ce") else "Cm" if name.startswith("cm") else \
+                      "P" if name.startswith(("p", "lluvia")) else None
+                if key is not None and key not in cols:
+                    cols[key] = (data[:, k], names[k])
+            if "P" not in cols:
+                raise ValueError(f"{path}: no se encontró la columna de precipitación (P).")
+        else:
+            for k, key in enumerate(("P", "Ce", "Cm")[:data.shape[1]]):
+                cols[key] = (data[:, k], None)
+    P, pname = cols["P"]
+    P = np.asarray(P, dtype=float)
+    Ce = np.asarray(cols["Ce"][0], dtype=float) if "Ce" in cols else np.full(P.size, DEFAULT_CE)
+    Cm = np.asarray(cols["Cm"][0], dtype=float) if "Cm" in cols else np.full(P.size, DEFAULT_CM)
+    if units is None and pname:
+        units = _header_units(path, pname, P_UNIT_NAMES, "precipitación")
+    if units is None:
+        name = _norm_name(pname) if pname else ""
+        units = "m" if name.endswith("_m") else "mm"
+    if units not in P_UNITS:
+        raise ValueError(f"Unidades de precipitación desconocidas: {units!r} (opciones: {', '.join(P_UNITS)}).")
+    if P.size == 0:
+        raise ValueError(f"{path}: no contiene datos.")
+    # mismas comprobaciones de longitud que compute_Q / compute_Y_from_hour_vectors
+    compute_effective_depth(P, Ce, Cm)
+    _check_finite("P", P, path, nonneg=True)
+    _check_finite("Ce", Ce, path)
+    _check_finite("Cm", Cm, path)
+    return P * P_UNITS[units], Ce, Cm
+
+def load_lags(path):
+    # retardo por área en horas; columna 'lag…'/'retardo…'/'t_viaje…' si hay cabecera (si no,
+    # la primera), así que puede ser el mismo archivo de áreas con una columna más
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".npz":
+        with np.load(path) as z:
+            if "lags" not in z.files:
+                raise ValueError(f"{path}: no contiene 'lags'.")
+            lags = np.asarray(z["lags"], dtype=float).reshape(-1)
+    else:
+        data, names, _ = _read_table(path, vector=True)
+        col = 0
+        if names:
+            norm = [_norm_name(n) for n in names]
+            col = next((k for k, n in enumerate(norm) if n.startswith(("lag", "retardo", "t_viaje"))), 0)
+        lags = np.asarray(data[:, col], dtype=float)
+    if lags.size == 0:
+        raise ValueError(f"{path}: no contiene datos.")
+    _check_finite("el retardo", lags, path, nonneg=True)
+    return lags
+
+def load_observed(path):
+    # caudal observado en la salida (m³/s) desde la hora 1; columna 'q…'/'caudal…'/'flow…' si
+    # hay cabecera (si no, la última). Los huecos van como NaN y no entran en la calibración.
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".npz":
+        with np.load(path) as z:
+            key = next((k for k in ("observed", "flows", "Q") if k in z.files), None)
+            if key is None:
+                raise ValueError(f"{path}: no contiene 'observed'.")
+            obs = np.asarray(z[key], dtype=float).reshape(-1)
+    else:
+        data, names, _ = _read_table(path, vector=True)
+        col = data.shape[1] - 1
+        if names:
+            norm = [_norm_name(n) for n in names]
+            col = next((k for k, n in enumerate(norm) if n.startswith(("q", "caudal", "flow"))), col)
+        obs = np.asarray(data[:, col], dtype=float)
+    if not np.isfinite(obs).any():
+        raise ValueError(f"{path}: no contiene caudales válidos.")
+    if np.any(obs[np.isfinite(obs)] < 0):
+        raise ValueError(f"{path}: el caudal contiene valores negativos.")
+    return obs
+
+# --------------------------
+# Exportación
+# --------------------------
+# Filas formateadas por bloque al escribir texto (acota la memoria del string)
+EXPORT_TEXT_CHUNK_ROWS = 65536
+# Bytes por bloque al exportar V en streaming
+EXPORT_V_CHUNK_BYTES = 64 * 1024 * 1024
+# Tipos de archivo del diálogo "Exportar"
+EXPORT_FILETYPES = [("CSV", ".csv"), ("NumPy (W, caudales y V factorizada)", ".npz")]
+# Formato crudo memory-mappable: firma + longitud del encabezado JSON + datos alineados
+RAW_MAGIC = b"SAHRAW1\n"
+RAW_ALIGN = 64
+
+def _write_text_rows(fh, row_fmt, table, chunk_rows=EXPORT_TEXT_CHUNK_ROWS):
+    # una sola operación de formato por bloque: (row_fmt * n) % valores
+    for s0 in range(0, table.shape[0], chunk_rows):
+        blk = table[s0:s0 + chunk_rows]
+        fh.write((row_fmt * blk.shape[0]) % tuple(blk.ravel().tolist()))
+
+def write_results_csv(filepath, W, flows):
+    # mismos bytes que csv.writer con f"{x:.6f}" (fin de línea \r\n), formateado por bloques
+    W = np.asarray(W, dtype=float).reshape(-1)
+    flows = np.asarray(flows, dtype=float).reshape(-1)
+    h = W.size
+    table = np.empty((h, 3), dtype=object)
+    table[:, 0] = np.arange(1, h + 1).tolist()
+    table[:, 1] = W.tolist()
+    table[:, 2] = flows.tolist()
+    with open(filepath, "w", newline="") as fh:
+        fh.write("Hora,Volumen_m3,Caudal_m3s\r\n")
+        _write_text_rows(fh, "%d,%.6f,%.6f\r\n", table)
+
+def _raw_header(dtype, shape, meta=None):
+    import json
+    header = json.dumps({"dtype": np.dtype(dtype).str, "shape": list(shape), "meta": meta or {}}).encode()
+    start = len(RAW_MAGIC) + 4 + len(header)
+    header += b" " * (-start % RAW_ALIGN)
+    return RAW_MAGIC + len(header).to_bytes(4, "little") + header
+
+def write_raw(path, arr, meta=None):
+    # arreglo crudo precedido de un encabezado JSON pequeño; se relee con read_raw sin parsear
+    arr = np.ascontiguousarray(arr)
+    with open(path, "wb") as fh:
+        fh.write(_raw_header(arr.dtype, arr.shape, meta))
+        arr.tofile(fh)
+
+def _read_raw_header(path):
+    import json
+    with open(path, "rb") as fh:
+        if fh.read(len(RAW_MAGIC)) != RAW_MAGIC:
+            raise ValueError(f"{path}: no es un archivo crudo SAH.")
+        n = int.from_bytes(fh.read(4), "little")
+        header = json.loads(fh.read(n).decode())
+    return header, len(RAW_MAGIC) + 4 + n
+
+def read_raw(path, mmap=True):
+    # devuelve (arreglo, meta); con mmap=True el arreglo es un np.memmap de sólo lectura
+    header, offset = _read_raw_header(path)
+    dtype, shape = np.dtype(header["dtype"]), tuple(header["shape"])
+    if mmap:
+        arr = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+    else:
+        arr = np.fromfile(path, dtype=dtype, offset=offset).reshape(shape)
+    return arr, header["meta"]
+
+def export_results_npz(path, W, flows, V=None, meta=None):
+    # corrida completa en .npz; V factorizada se guarda como sus dos vectores
+    import json
+    arrays = {"W": np.asarray(W, dtype=float), "flows": np.asarray(flows, dtype=float)}
+    if isinstance(V, FactoredV):
+        arrays["V_A"] = V.A
+        arrays["V_q"] = V.q
+    elif V is not None:
+        arrays["V"] = np.asarray(V, dtype=float)
+    arrays["meta"] = np.array(json.dumps(meta or {}))
+    np.savez(path, **arrays)
+
+def load_results_npz(path):
+    import json
+    with np.load(path) as z:
+        out = {k: z[k] for k in z.files if k != "meta"}
+        meta = json.loads(str(z["meta"])) if "meta" in z.files else {}
+    if "V_A" in out:
+        out["V"] = FactoredV(out.pop("V_A"), out.pop("V_q"))
+    out["meta"] = meta
+    return out
+
+def export_ensemble_npz(path, result, meta=None):
+    import json
+    np.savez(path, W=result.W, flows=result.flows, peak_flow=result.peak_flow,
+             peak_hour=result.peak_hour, total_volume=result.total_volume,
+             meta=np.array(json.dumps(meta or {})))
+
+def export_V(path, V, fmt=None, chunk_bytes=EXPORT_V_CHUNK_BYTES):
+    # escribe V por bloques de filas (nunca la matriz completa en memoria).
+    # fmt: "npy" (memmap al releer), "raw" (read_raw) o "csv"; por defecto según la extensión
+    if fmt is None:
+        ext = os.path.splitext(path)[1].lower()
+        fmt = {".npy": "npy", ".csv": "csv"}.get(ext, "raw")
+    if not isinstance(V, FactoredV) and not hasattr(V, "dtype"):
+        V = np.asarray(V, dtype=float)
+    a, p = V.shape
+    rows = max(1, int(chunk_bytes // (8 * max(p, 1))))
+    if fmt == "csv":
+        with open(path, "w", newline="") as fh:
+            row_fmt = ",".join(["%.6f"] * p) + "\r\n"
+            for i0 in range(0, a, rows):
+                _write_text_rows(fh, row_fmt, np.asarray(V[i0:i0 + rows, :], dtype=float))
+        return path
+    if fmt == "npy":
+        out = np.lib.format.open_memmap(path, mode="w+", dtype=np.float64, shape=(a, p))
+        for i0 in range(0, a, rows):
+            out[i0:i0 + rows] = V[i0:i0 + rows, :]
+        out.flush()
+        del out
+        return path
+    if fmt == "raw":
+        with open(path, "wb") as fh:
+            fh.write(_raw_header("<f8", (a, p)))
+            for i0 in range(0, a, rows):
+                np.ascontiguousarray(V[i0:i0 + rows, :], dtype="<f8").tofile(fh)
+        return path
+    raise ValueError(f"Formato de exportación desconocido: {fmt!r} (opciones: npy, raw, csv).")
+
+# --------------------------
+# Servicio HTTP (JSON)
+# --------------------------
+# Servidor local sólo con la biblioteca estándar (asyncio). Las corridas chicas que llegan
+# casi juntas se agrupan por cuenca y se resuelven con un solo compute_W_batch; las grandes
+# (y todo el JSON voluminoso) se procesan en un pool para no bloquear el bucle de eventos.
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+# Espera máxima (s) para juntar corridas chicas en un lote, y tamaño máximo del lote
+SERVICE_BATCH_WINDOW = 0.002
+SERVICE_MAX_BATCH = 256
+# Corridas con a·p hasta este valor se agrupan; las mayores van directo al pool
+SERVICE_SMALL_CELLS = 1 << 16
+# Cuerpos hasta este tamaño se decodifican en el bucle; los mayores, en el pool
+SERVICE_INLINE_BODY = 256 * 1024
+SERVICE_MAX_BODY = 64 * 1024 * 1024
+# Latencias recientes que se guardan por ruta para los percentiles de /metrics
+SERVICE_LATENCY_WINDOW = 10_000
+# Rutas del servicio; las demás solicitudes (404/405/mal formadas) comparten la clave "?"
+SERVICE_ROUTES = ("/simulate", "/ensemble", "/metrics", "/health")
+
+def _service_field(req, name):
+    try:
+        return req[name]
+    except (KeyError, TypeError):
+        raise ValueError(f"Falta el campo '{name}'.")
+
+def _service_coef(req, name, default, p):
+    # Ce/Cm: serie, matriz (ensambles) o un único valor para todas las horas
+    v = req.get(name, default)
+    return np.full(p, float(v)) if np.ndim(v) == 0 else v
+
+def _service_inputs(req):
+    A_m2 = np.asarray(_service_field(req, "areas_km2"), dtype=float).reshape(-1) * 1e6
+    P = np.asarray(_service_field(req, "P_mm"), dtype=float).reshape(-1)
+    if A_m2.size == 0 or P.size == 0:
+        raise ValueError("Se necesita al menos un área y una precipitación.")
+    q = compute_effective_depth(P, _service_coef(req, "Ce", DEFAULT_CE, P.size),
+                                _service_coef(req, "Cm", DEFAULT_CM, P.size),
+                                units_mm=bool(req.get("units_mm", True)))
+    engine = req.get("engine", "auto")
+    if engine not in W_ENGINES:
+        raise ValueError(f"Motor de W desconocido: {engine!r} (opciones: {', '.join(W_ENGINES)}).")
+    return A_m2, q, engine
+
+def _service_run_result(W, series=True):
+    flows = W / 3600.0
+    k = int(np.argmax(flows))
+    out = {"h": int(W.size), "peak_flow": float(flows[k]), "peak_hour": k + 1,
+           "total_volume": float(W.sum())}
+    if series:
+        out["W"] = W.tolist()
+        out["flows"] = flows.tolist()
+    return out
+
+def _service_simulate(req):
+    # corrida grande en el pool: decodifica (si llega en bytes), calcula y codifica
+    import json
+    if isinstance(req, (bytes, bytearray)):
+        req = json.loads(req)
+    A_m2, q, engine = _service_inputs(req)
+    return json.dumps(_service_run_result(compute_W(A_m2, q, engine=engine),
+                                          series=req.get("series", True))).encode()
+
+def _service_ensemble(req):
+    import json
+    if isinstance(req, (bytes, bytearray)):
+        req = json.loads(req)
+    P = _service_field(req, "P_mm")
+    p = np.shape(P)[-1] if np.ndim(P) else 0
+    res = simulate_ensemble(_service_field(req, "areas_km2"), P, _service_coef(req, "Ce", DEFAULT_CE, p),
+                            _service_coef(req, "Cm", DEFAULT_CM, p), units_mm=bool(req.get("units_mm", True)),
+                            engine=req.get("engine", "auto"))
+    out = {"n_storms": res.n_storms, "h": int(res.W.shape[1]), "peak_flow": res.peak_flow.tolist(),
+           "peak_hour": res.peak_hour.tolist(), "total_volume": res.total_volume.tolist()}
+    if req.get("series", True):
+        out["W"] = res.W.tolist()
+        out["flows"] = res.flows.tolist()
+    return json.dumps(out).encode()
+
+def _service_batch(A_m2, Q, engine, series):
+    # lote de corridas chicas con la misma cuenca: una fila de Q por corrida
+    import json
+    W = compute_W_batch(A_m2, Q, engine=engine)
+    return [json.dumps(_service_run_result(row, series=s)).encode() for row, s in zip(W, series)]
+
+class SimulationService:
+    # POST /simulate  {"areas_km2", "P_mm", "Ce", "Cm", "units_mm", "engine", "series"}
+    # POST /ensemble  igual, con P_mm (y opcionalmente Ce/Cm) como matriz n_tormentas × p
+    # GET  /metrics   latencias (p50/p90/p99), profundidad de cola, lotes
+    # GET  /health
+    def __init__(self, host=SERVICE_HOST, port=SERVICE_PORT, workers=None, executor="thread",
+                 batch_window=SERVICE_BATCH_WINDOW, max_batch=SERVICE_MAX_BATCH,
+                 small_cells=SERVICE_SMALL_CELLS):
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.executor_kind = executor
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.small_cells = small_cells
+        self.server = None
+        self.pool = None
+        self._queue = None
+        self._batcher = None
+        self._latency = {}
+        self.counters = {"requests": 0, "errors": 0, "batches": 0, "batched_runs": 0, "pool_tasks": 0}
+        self.in_flight = 0
+
+    async def start(self):
+        import asyncio
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        if self.executor_kind == "process":
+            import multiprocessing
+            # sin fork: un hijo creado con fork heredaría los sockets abiertos de los clientes
+            # y la conexión no se cerraría hasta que terminara el proceso de trabajo
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                            mp_context=multiprocessing.get_context(method))
+        elif self.executor_kind == "thread":
+            self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        else:
+            raise ValueError(f"Tipo de pool desconocido: {self.executor_kind!r} (thread o process).")
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.ensure_future(self._batch_loop())
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        # con port=0 el sistema elige uno libre
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        import asyncio
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+
+    async def _in_pool(self, fn, *args):
+        import asyncio
+        self.in_flight += 1
+        self.counters["pool_tasks"] += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+        finally:
+            self.in_flight -= 1
+
+    async def _batch_loop(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self._queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(items) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            groups = {}
+            for item in items:
+                groups.setdefault(item[0], []).append(item)
+            for group in groups.values():
+                asyncio.ensure_future(self._run_group(group))
+
+    async def _run_group(self, group):
+        _, A_m2, _, engine, _, _ = group[0]
+        Q = np.vstack([item[2] for item in group])
+        self.counters["batches"] += 1
+        self.counters["batched_runs"] += len(group)
+        try:
+            bodies = await self._in_pool(_service_batch, A_m2, Q, engine, [item[4] for item in group])
+        except Exception as e:
+            for item in group:
+                if not item[5].done():
+                    item[5].set_exception(e)
+            return
+        for item, body in zip(group, bodies):
+            if not item[5].done():
+                item[5].set_result(body)
+
+    async def _simulate(self, body):
+        import asyncio
+        import json
+        if len(body) > SERVICE_INLINE_BODY:
+            return await self._in_pool(_service_simulate, body)
+        req = json.loads(body)
+        A_m2, q, engine = _service_inputs(req)
+        if A_m2.size * q.size > self.small_cells:
+            return await self._in_pool(_service_simulate, req)
+        fut = asyncio.get_running_loop().create_future()
+        # mismas áreas, p y motor -> mismo lote
+        key = (A_m2.tobytes(), q.size, engine)
+        await self._queue.put((key, A_m2, q, engine, bool(req.get("series", True)), fut))
+        return await fut
+
+    def metrics(self):
+        out = {"queue_depth": self._queue.qsize() if self._queue is not None else 0,
+               "in_flight": self.in_flight, "workers": self.workers, "executor": self.executor_kind,
+               **self.counters, "latency_ms": {}}
+        for route, lat in self._latency.items():
+            arr = np.asarray(lat) * 1000.0
+            p50, p90, p99 = np.percentile(arr, (50, 90, 99))
+            out["latency_ms"][route] = {"count": int(arr.size), "p50": float(p50), "p90": float(p90),
+                                        "p99": float(p99), "max": float(arr.max())}
+        return out
+
+    async def _dispatch(self, method, path, body):
+        import json
+        path = path.split("?", 1)[0]
+        routes = {("POST", "/simulate"): self._simulate,
+                  ("POST", "/ensemble"): lambda b: self._in_pool(_service_ensemble, b)}
+        if method == "GET" and path == "/metrics":
+            return 200, json.dumps(self.metrics()).encode()
+        if method == "GET" and path == "/health":
+            return 200, b'{"status": "ok"}'
+        handler = routes.get((method, path))
+        if handler is None:
+            if path in SERVICE_ROUTES:
+                return 405, json.dumps({"error": f"Método no permitido: {method}"}).encode()
+            return 404, json.dumps({"error": f"Ruta desconocida: {path}"}).encode()
+        try:
+            return 200, await handler(body)
+        except (ValueError, TypeError) as e:
+            # incluye JSON inválido (JSONDecodeError es un ValueError)
+            return 400, json.dumps({"error": str(e)}).encode()
+        except Exception as e:
+            return 500, json.dumps({"error": f"{type(e).__name__}: {e}"}).encode()
+
+    async def _handle(self, reader, writer):
+        import asyncio
+        import time
+        from collections import deque
+        reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                   413: "Payload Too Large", 500: "Internal Server Error"}
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                t0 = time.perf_counter()
+                parts = line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""):
+                        break
+                    k, _, v = h.decode("latin-1").partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                keep = len(parts) == 3 and parts[2] == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                n = int(headers.get("content-length", 0) or 0)
+                if len(parts) != 3:
+                    status, payload, path, keep = 400, b'{"error": "Solicitud HTTP mal formada."}', "?", False
+                elif n > SERVICE_MAX_BODY:
+                    status, payload, path, keep = 413, b'{"error": "Cuerpo demasiado grande."}', parts[1], False
+                else:
+                    body = await reader.readexactly(n) if n else b""
+                    path = parts[1].split("?", 1)[0]
+                    status, payload = await self._dispatch(parts[0].upper(), parts[1], body)
+                self.counters["requests"] += 1
+                if status != 200:
+                    self.counters["errors"] += 1
+                writer.write((f"HTTP/1.1 {status} {reasons[status]}\r\n"
+                              f"Content-Type: application/json\r\n"
+                              f"Content-Length: {len(payload)}\r\n"
+                              f"Connection: {'keep-alive' if keep else 'close'}\r\n\r\n").encode() + payload)
+                await writer.drain()
+                # una clave fija para lo que no es una ruta atendida: rutas arbitrarias no
+                # agregan entradas nuevas a _latency
+                route = path if status not in (404, 405) and path in SERVICE_ROUTES else "?"
+                self._latency.setdefault(route, deque(maxlen=SERVICE_LATENCY_WINDOW)).append(time.perf_counter() - t0)
+                if not keep:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+def run_service(host=SERVICE_HOST, port=SERVICE_PORT, workers=None, executor="thread"):
+    import asyncio
+    service = SimulationService(host, port, workers=workers, executor=executor)
+
+    async def main():
+        await service.start()
+        print(f"Servicio SAH en http://{service.host}:{service.port} (Ctrl+C para terminar)")
+        try:
+            await service.server.serve_forever()
+        finally:
+            await service.stop()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+# --------------------------
+# Benchmarks
+# --------------------------
+# Tamaños (a×p) por defecto: desde el ejemplo de la interfaz hasta ~10⁵ horas
+BENCH_SIZES = ((3, 4), (100, 1_000), (1_000, 10_000), (10_000, 100_000))
+# Tiempo máximo por caso (s) para repetir mediciones; siempre se hace al menos una
+BENCH_BUDGET = 2.0
+# Un caso se marca como regresión si tarda más de umbral × la línea base...
+BENCH_THRESHOLD = 1.5
+# ...y además la diferencia supera este piso (s), para no alarmar por ruido en casos de µs
+BENCH_NOISE_FLOOR = 1e-3
+BENCH_BASELINE = "bench_baseline.json"
+
+def _bench_inputs(a, p, seed=0):
+    rng = np.random.default_rng(seed)
+    areas = rng.uniform(0.1, 5.0, a)
+    P = rng.gamma(0.6, 8.0, p)
+    Ce = rng.uniform(0.2, 0.8, p)
+    Cm = rng.uniform(0.9, 1.1, p)
+    return areas, P, Ce, Cm
+
+def _bench_core(a, p):
+    areas, P, Ce, Cm = _bench_inputs(a, p)
+    A_m2 = areas * 1e6
+    q = compute_effective_depth(P, Ce, Cm)
+    V = FactoredV(A_m2, q)
+
+    def dense():
+        Y = compute_Y_from_hour_vectors(Ce, Cm, a)
+        return compute_V(A_m2, compute_Q(P, Y))
+
+    def stream():
+        sh = StreamingHydrograph(areas)
+        for j in range(p):
+            sh.push(P[j], Ce[j], Cm[j])
+        # flush es un generador: hay que consumirlo para que entregue la recesión
+        for _ in sh.flush():
+            pass
+
+    storms = np.vstack([P * s for s in np.linspace(0.5, 1.5, 16)])
+    cases = [
+        ("V_densa (Y,Q,V)", 2e7, dense),
+        ("W_referencia (bucle)", 2e5, lambda: compute_W_from_V(V.toarray())),
+        ("W_auto", None, lambda: compute_W(A_m2, q)),
+        ("W_direct", 2e8, lambda: compute_W(A_m2, q, engine="direct")),
+        ("W_fft", None, lambda: compute_W(A_m2, q, engine="fft")),
+        ("W_bloques (V densa)", 5e7, None),
+        ("V_factorizada", None, lambda: compute_V_factored(A_m2, P, Ce, Cm).W()),
+        ("ensamble x16", None, lambda: simulate_ensemble(areas, storms, Ce, Cm)),
+        ("streaming", 2e8, stream),
+        ("aportes hora", None, lambda: hour_contributions(V, (a + p) // 2)),
+    ]
+    out = []
+    for name, max_cells, fn in cases:
+        if max_cells is not None and a * p > max_cells:
+            continue
+        if fn is None:
+            dense_V = V.toarray()
+            fn = lambda: compute_W_blocked(dense_V, max_bytes=1 << 22)
+        out.append((name, fn, a * p, "celdas"))
+    return out
+
+def _bench_render(a, p):
+    # sólo Agg: ni pantalla ni Tk
+    import matplotlib
+    matplotlib.use("Agg", force=True)
+    _load_plotting()
+    areas, P, Ce, Cm = _bench_inputs(a, p)
+    W, flows = run_storm(areas, P, Ce, Cm)
+    h = W.size
+    out = []
+    # draw_main_plot crea una barra por hora: por encima de unas miles de horas sólo mide a matplotlib
+    if h <= 2_000:
+        fig = plt.figure(figsize=(8, 4), dpi=100)
+
+        def main_plot():
+            f, ax = draw_main_plot(fig, None, W, flows)
+            f.canvas.draw()
+        out.append(("draw_main_plot (Agg)", main_plot, h, "horas"))
+    fig2 = plt.figure(figsize=(8, 4), dpi=100)
+    mgr = MainPlotManager(fig2, redraw=fig2.canvas.draw)
+
+    def manager():
+        mgr.set_data(W, flows)
+        mgr.show()
+    out.append(("MainPlotManager (Agg)", manager, h, "horas"))
+    if a <= 2_000:
+        fig3 = plt.figure(figsize=(9, 5), dpi=100)
+        ax3 = fig3.add_subplot(111)
+        scene = WatershedScene(ax3, areas, FactoredV(areas * 1e6, compute_effective_depth(P, Ce, Cm)),
+                               p, animated=True)
+        canvas = fig3.canvas
+        scene.update(1)
+        canvas.draw()
+        bg = canvas.copy_from_bbox(fig3.bbox)
+        hours = np.linspace(1, h, 20).astype(int)
+
+        def draw_for_hour():
+            # mismo camino que el deslizador del simulador: restaurar fondo + artistas dinámicos
+            for k in hours:
+                scene.update(int(k))
+                canvas.restore_region(bg)
+                for art in scene.dynamic_artists:
+                    fig3.draw_artist(art)
+                canvas.blit(fig3.bbox)
+        out.append(("draw_for_hour x20 (Agg)", draw_for_hour, 20, "horas"))
+    return out
+
+def _bench_export(a, p, tmpdir):
+    from types import SimpleNamespace
+    areas, P, Ce, Cm = _bench_inputs(a, p)
+    W, flows = run_storm(areas, P, Ce, Cm)
+    # _export_csv_to sólo lee el estado last_* de la app
+    app = SimpleNamespace(last_inputs=(areas, P, Ce, Cm), last_W=W, last_flows=flows,
+                          last_V=FactoredV(areas * 1e6, compute_effective_depth(P, Ce, Cm)),
+                          last_a=a, last_p=p)
+    csv_path = os.path.join(tmpdir, "bench.csv")
+    npz_path = os.path.join(tmpdir, "bench.npz")
+    return [
+        ("_export_csv_to .csv", lambda: SAHAppV3._export_csv_to(app, csv_path), W.size, "filas"),
+        ("_export_csv_to .npz", lambda: SAHAppV3._export_csv_to(app, npz_path), W.size, "filas"),
+    ]
+
+def _bench_measure(fn, budget=BENCH_BUDGET, repeat=5):
+    import time
+    import tracemalloc
+    times = []
+    start = time.perf_counter()
+    while len(times) < repeat and (not times or time.perf_counter() - start < budget):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    # memoria en una corrida aparte: tracemalloc distorsiona los tiempos
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return times, peak
+
+def run_benchmarks(sizes=BENCH_SIZES, groups=("core", "render", "export"), only=None,
+                   budget=BENCH_BUDGET, repeat=5, report=print):
+    import platform
+    import tempfile
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for a, p in sizes:
+            cases = []
+            if "core" in groups:
+                cases += _bench_core(a, p)
+            if "render" in groups:
+                cases += _bench_render(a, p)
+            if "export" in groups:
+                cases += _bench_export(a, p, tmpdir)
+            for name, fn, work, unit in cases:
+                if only and only.lower() not in name.lower():
+                    continue
+                times, peak = _bench_measure(fn, budget=budget, repeat=repeat)
+                best = min(times)
+                rec = {"case": name, "a": a, "p": p, "best_s": best,
+                       "median_s": float(np.median(times)), "runs": len(times),
+                       "throughput": work / best if best > 0 else None, "unit": f"{unit}/s",
+                       "peak_bytes": peak}
+                results[f"{name} @ {a}x{p}"] = rec
+                if report:
+                    report(f"{name:<26} {a:>6}x{p:<7} {best*1000:10.3f} ms  "
+                           f"{rec['throughput'] or 0:12.3g} {unit}/s  {peak/1e6:8.2f} MB")
+    try:
+        import matplotlib
+        mpl = matplotlib.__version__
+    except ImportError:
+        mpl = None
+    return {"version": 1, "python": platform.python_version(), "numpy": np.__version__,
+            "matplotlib": mpl, "machine": platform.machine(), "platform": platform.platform(),
+            "threshold": BENCH_THRESHOLD, "results": results}
+
+def compare_benchmarks(current, baseline, threshold=None):
+    # devuelve [(clave, actual_s, base_s, razón)] de los casos más lentos que la línea base
+    threshold = threshold or baseline.get("threshold", BENCH_THRESHOLD)
+    regressions = []
+    for key, rec in current["results"].items():
+        base = baseline.get("results", {}).get(key)
+        if base is None:
+            continue
+        ratio = rec["best_s"] / base["best_s"] if base["best_s"] > 0 else float("inf")
+        if ratio > threshold and rec["best_s"] - base["best_s"] > BENCH_NOISE_FLOOR:
+            regressions.append((key, rec["best_s"], base["best_s"], ratio))
+    return regressions
+
+def _parse_sizes(text):
+    try:
+        return tuple(tuple(int(v) for v in item.lower().split("x")) for item in text.split(","))
+    except ValueError:
+        raise ValueError(f"Tamaños inválidos: {text!r} (formato: 3x4,100x1000)")
+
+# --------------------------
+# Línea de comandos (sin GUI)
+# --------------------------
+def run_storm(areas_km2, P_mm, Ce, Cm, units_mm=True, engine="auto", lags=None):
+    A_m2 = np.asarray(areas_km2, dtype=float) * 1e6
+    if lags is not None:
+        W = compute_W_lagged(A_m2, compute_effective_depth(P_mm, Ce, Cm, units_mm=units_mm), lags, engine=engine)
+        return W, W / 3600.0
+    V = compute_V_factored(A_m2, P_mm, Ce, Cm, units_mm=units_mm)
+    W = V.W(engine=engine)
+    return W, W / 3600.0
+
+def _storm_files(storm, pattern):
+    if os.path.isdir(storm):
+        import fnmatch
+        names = sorted(n for n in os.listdir(storm) if fnmatch.fnmatch(n, pattern))
+        return [os.path.join(storm, n) for n in names]
+    return [storm]
+
+def cmd_run(args):
+    try:
+        areas = load_areas(args.areas)
+        lags = load_lags(args.lags) if args.lags else None
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    if lags is not None and lags.size != areas.size:
+        print(f"Error: {args.lags} tiene {lags.size} retardos para {areas.size} áreas", file=sys.stderr)
+        return 2
+    storms = _storm_files(args.storm, args.pattern)
+    if not storms:
+        print(f"No hay archivos '{args.pattern}' en {args.storm}", file=sys.stderr)
+        return 1
+    out_is_dir = os.path.isdir(args.storm) or args.out.endswith(os.sep) or os.path.isdir(args.out)
+    if out_is_dir:
+        os.makedirs(args.out, exist_ok=True)
+    for path in storms:
+        try:
+            P, Ce, Cm = load_storm(path, units=args.units)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 2
+        W, flows = run_storm(areas, P, Ce, Cm, units_mm=True, engine=args.engine, lags=lags)
+        out = os.path.join(args.out, os.path.basename(path)) if out_is_dir else args.out
+        write_results_csv(out, W, flows)
+        k = int(np.argmax(flows))
+        if not args.quiet:
+            print(f"{path}: h={W.size}  pico={flows[k]:.4f} m³/s (hora {k+1})  "
+                  f"volumen={W.sum():.2f} m³ -> {out}")
+    return 0
+
+def cmd_calibrate(args):
+    try:
+        areas = load_areas(args.areas)
+        P, Ce, Cm = load_storm(args.storm, units=args.units)
+        obs = load_observed(args.observed)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    groups = rain_event_groups(P, args.dry_hours, args.threshold) if args.groups == "events" else args.groups
+    bounds = None
+    if args.min is not None or args.max is not None:
+        lo, hi = (0.0, 1.0) if args.fit == "ce" else (0.0, np.inf)
+        bounds = (lo if args.min is None else args.min, hi if args.max is None else args.max)
+    res = calibrate(areas, P, obs, Ce=Ce, Cm=Cm, groups=groups, fit=args.fit, bounds=bounds)
+    print(res.summary())
+    n_fixed = int((~res.identifiable).sum())
+    if n_fixed:
+        print(f"{n_fixed} grupos sin lluvia conservan el valor inicial")
+    if args.out:
+        # misma forma que las series de tormenta: se puede volver a cargar con --storm
+        table = np.column_stack([P, res.Ce, res.Cm])
+        with open(args.out, "w", newline="") as fh:
+            fh.write("P_mm,Ce,Cm\r\n")
+            _write_text_rows(fh, "%.6f,%.6f,%.6f\r\n", table)
+    if args.residuals:
+        n = res.residuals.size
+        table = np.column_stack([np.arange(1, n + 1), obs[:n], res.flows[:n], res.residuals])
+        with open(args.residuals, "w", newline="") as fh:
+            fh.write("Hora,Caudal_obs_m3s,Caudal_sim_m3s,Residuo_m3s\r\n")
+            _write_text_rows(fh, "%d,%.6f,%.6f,%.6f\r\n", table)
+    return 0 if res.converged else 1
+
+def cmd_events(args):
+    try:
+        areas = load_areas(args.areas)
+        P, Ce, Cm = load_storm(args.storm, units=args.units)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    table = simulate_events(areas, P, Ce, Cm, min_dry_hours=args.dry_hours, threshold=args.threshold,
+                            min_depth=args.min_depth, engine=args.engine)
+    if args.out:
+        table.write_csv(args.out)
+    print(f"{len(table)} eventos en {P.size} horas")
+    top = table.top(args.top)
+    print(f"{'#':>4} {'inicio':>9} {'dur(h)':>7} {'lluvia(mm)':>11} {'pico(m³/s)':>11} {'hora pico':>10} {'volumen(m³)':>13}")
+    for r in range(len(top)):
+        print(f"{r+1:>4} {top.start_hour[r]:>9} {top.duration[r]:>7} {top.depth_mm[r]:>11.2f} "
+              f"{top.peak_flow[r]:>11.4f} {top.peak_hour[r]:>10} {top.volume[r]:>13.2f}")
+    return 0
+
+def _parse_hours(text, h):
+    # "1-200", "5,10,20" o combinaciones; None = todas las horas
+    if not text:
+        return None
+    out = []
+    for part in text.split(","):
+        lo, _, hi = part.strip().partition("-")
+        try:
+            lo = int(lo)
+            hi = int(hi) if hi else lo
+        except ValueError:
+            raise ValueError(f"Rango de horas inválido: {part.strip()!r} (ej.: 1-200 o 5,10,20)")
+        out.extend(range(lo, min(hi, h) + 1))
+    return out
+
+def cmd_animate(args):
+    try:
+        areas = load_areas(args.areas)
+        P, Ce, Cm = load_storm(args.storm, units=args.units)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    V = compute_V_factored(areas * 1e6, P, Ce, Cm)
+    try:
+        hours = _parse_hours(args.hours, V.h)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    import time
+    t0 = time.perf_counter()
+    n = render_simulator_animation(areas, V, P.size, args.out, hours=hours, workers=args.workers,
+                                   fps=args.fps, dpi=args.dpi)
+    print(f"{n} fotogramas en {time.perf_counter() - t0:.2f} s -> {args.out}")
+    return 0
+
+def cmd_serve(args):
+    run_service(args.host, args.port, workers=args.workers, executor=args.executor)
+    return 0
+
+def cmd_import_time(args):
+    # mide el import del núcleo en un intérprete limpio y comprueba que no cargue la GUI
+    import subprocess
+    code = ("import sys,time;t=time.perf_counter();import SAH;"
+            "dt=time.perf_counter()-t;"
+            "gui=[m for m in ('tkinter','matplotlib') if m in sys.modules];"
+            "print(f'{dt*1000:.1f}', ','.join(gui))")
+    here = os.path.dirname(os.path.abspath(__file__))
+    best, gui = None, ""
+    for _ in range(args.repeat):
+        out = subprocess.run([sys.executable, "-c", code], cwd=here, capture_output=True,
+                             text=True, check=True).stdout.split()
+        ms = float(out[0])
+        best = ms if best is None else min(best, ms)
+        gui = out[1] if len(out) > 1 else ""
+    print(f"import SAH: {best:.1f} ms (mejor de {args.repeat})")
+    if gui:
+        print(f"AVISO: el import cargó módulos de GUI: {gui}", file=sys.stderr)
+        return 1
+    return 0
+
+def cmd_bench(args):
+    import json
+    try:
+        sizes = _parse_sizes(args.sizes)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    groups = tuple(g.strip() for g in args.groups.split(","))
+    current = run_benchmarks(sizes, groups=groups, only=args.only, budget=args.budget, repeat=args.repeat)
+    if args.threshold is not None:
+        current["threshold"] = args.threshold
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fh:
+            json.dump(current, fh, indent=1)
+    baseline_path = args.baseline or BENCH_BASELINE
+    if args.save_baseline:
+        with open(baseline_path, "w", encoding="utf-8") as fh:
+            json.dump(current, fh, indent=1)
+        print(f"Línea base guardada en {baseline_path}")
+        return 0
+    if not os.path.exists(baseline_path):
+        if args.baseline:
+            print(f"Error: no existe la línea base {baseline_path}", file=sys.stderr)
+            return 2
+        return 0
+    with open(baseline_path, encoding="utf-8") as fh:
+        baseline = json.load(fh)
+    regressions = compare_benchmarks(current, baseline, threshold=args.threshold)
+    for key, now, base, ratio in regressions:
+        print(f"REGRESIÓN {key}: {now*1000:.3f} ms vs {base*1000:.3f} ms (x{ratio:.2f})", file=sys.stderr)
+    shared = len(set(current["results"]) & set(baseline.get("results", {})))
+    print(f"{shared} casos comparados con {baseline_path}, {len(regressions)} regresiones")
+    return 1 if regressions else 0
+
+def build_arg_parser():
+    import argparse
+    parser = argparse.ArgumentParser(prog="SAH.py", description="SAH - Volúmenes pasantes (modelo PVCS)")
+    sub = parser.add_subparsers(dest="command")
+    run = sub.add_parser("run", help="simula uno o varios CSV de tormenta sin abrir la interfaz")
+    run.add_argument("--areas", required=True, help="CSV/NPY/NPZ con las áreas (km² salvo cabecera m2/ha)")
+    run.add_argument("--storm", required=True, help="serie de tormenta (P[, Ce[, Cm]]) o carpeta de series")
+    run.add_argument("--out", required=True, help="CSV de salida, o carpeta si --storm es carpeta")
+    run.add_argument("--pattern", default="*.csv", help="patrón de archivos si --storm es carpeta")
+    run.add_argument("--units", choices=tuple(P_UNITS), default=None,
+                     help="unidades de P (por defecto según la cabecera, o mm)")
+    run.add_argument("--engine", choices=W_ENGINES, default="auto", help="motor de cálculo de W")
+    run.add_argument("--lags", default=None,
+                     help="retardo (horas) por área; por defecto el área i drena i-1 horas después")
+    run.add_argument("-q", "--quiet", action="store_true", help="no imprimir resumen por tormenta")
+    run.set_defaults(func=cmd_run)
+    cal = sub.add_parser("calibrate", help="ajusta Ce (o un factor de Cm) a caudales observados")
+    cal.add_argument("--areas", required=True, help="CSV/NPY/NPZ con las áreas")
+    cal.add_argument("--storm", required=True, help="serie de tormenta (P[, Ce[, Cm]]); Ce/Cm son el valor inicial")
+    cal.add_argument("--observed", required=True, help="caudal observado en la salida (m³/s) por hora")
+    cal.add_argument("--fit", choices=CALIB_FITS, default="ce", help="parámetro a ajustar")
+    cal.add_argument("--groups", choices=("hourly", "events", "global"), default="events",
+                     help="un valor por hora, por evento de lluvia o uno solo")
+    cal.add_argument("--dry-hours", type=int, default=6, help="horas secas que separan eventos")
+    cal.add_argument("--threshold", type=float, default=0.0, help="lluvia horaria (mm) que cuenta como seca")
+    cal.add_argument("--min", type=float, default=None, help="límite inferior del parámetro")
+    cal.add_argument("--max", type=float, default=None, help="límite superior del parámetro")
+    cal.add_argument("--units", choices=tuple(P_UNITS), default=None, help="unidades de P")
+    cal.add_argument("--out", default=None, help="CSV con P, Ce y Cm calibrados")
+    cal.add_argument("--residuals", default=None, help="CSV con observado, simulado y residuo por hora")
+    cal.set_defaults(func=cmd_calibrate)
+    ev = sub.add_parser("events", help="separa eventos de un registro largo y los ordena por caudal pico")
+    ev.add_argument("--areas", required=True, help="CSV/NPY/NPZ con las áreas")
+    ev.add_argument("--storm", required=True, help="registro horario (P[, Ce[, Cm]])")
+    ev.add_argument("--dry-hours", type=int, default=6, help="horas secas mínimas entre eventos")
+    ev.add_argument("--threshold", type=float, default=0.0, help="lluvia horaria (mm) que cuenta como seca")
+    ev.add_argument("--min-depth", type=float, default=0.0, help="lluvia total mínima del evento (mm)")
+    ev.add_argument("--top", type=int, default=10, help="eventos a imprimir")
+    ev.add_argument("--out", default=None, help="CSV con la tabla completa ordenada")
+    ev.add_argument("--units", choices=tuple(P_UNITS), default=None, help="unidades de P")
+    ev.add_argument("--engine", choices=W_ENGINES, default="auto", help="motor de cálculo de W")
+    ev.set_defaults(func=cmd_events)
+    an = sub.add_parser("animate", help="exporta el simulador hora a hora (GIF o PNG) sin pantalla")
+    an.add_argument("--areas", required=True, help="CSV/NPY/NPZ con las áreas")
+    an.add_argument("--storm", required=True, help="serie de tormenta (P[, Ce[, Cm]])")
+    an.add_argument("--out", required=True, help="archivo .gif, o carpeta para un PNG por hora")
+    an.add_argument("--hours", default=None, help="horas a exportar (p. ej. 1-200 o 5,10,20); por defecto todas")
+    an.add_argument("--workers", type=int, default=None, help="procesos de render (por defecto, núcleos)")
+    an.add_argument("--fps", type=float, default=ANIM_FPS, help="fotogramas por segundo del GIF")
+    an.add_argument("--dpi", type=int, default=ANIM_DPI, help="resolución de los fotogramas")
+    an.add_argument("--units", choices=tuple(P_UNITS), default=None, help="unidades de P")
+    an.set_defaults(func=cmd_animate)
+    srv = sub.add_parser("serve", help="servicio HTTP local (JSON) con /simulate, /ensemble y /metrics")
+    srv.add_argument("--host", default=SERVICE_HOST)
+    srv.add_argument("--port", type=int, default=SERVICE_PORT)
+    srv.add_argument("--workers", type=int, default=None, help="tamaño del pool (por defecto, núcleos)")
+    srv.add_argument("--executor", choices=("thread", "process"), default="thread",
+                     help="pool de hilos o de procesos para las corridas")
+    srv.set_defaults(func=cmd_serve)
+    imp = sub.add_parser("import-time", help="mide el tiempo de import del núcleo")
+    imp.add_argument("--repeat", type=int, default=5)
+    imp.set_defaults(func=cmd_import_time)
+    bench = sub.add_parser("bench", help="mide tiempos y memoria del núcleo, gráficos y exportación")
+    bench.add_argument("--sizes", default=",".join(f"{a}x{p}" for a, p in BENCH_SIZES),
+                       help="tamaños a×p separados por comas (p. ej. 3x4,100x1000)")
+    bench.add_argument("--groups", default="core,render,export", help="grupos a medir")
+    bench.add_argument("--only", default=None, help="sólo casos cuyo nombre contenga este texto")
+    bench.add_argument("--repeat", type=int, default=5, help="repeticiones máximas por caso")
+    bench.add_argument("--budget", type=float, default=BENCH_BUDGET, help="segundos máximos por caso")
+    bench.add_argument("--out", default=None, help="guardar los resultados (JSON)")
+    bench.add_argument("--baseline", default=None,
+                       help=f"comparar contra esta línea base (por defecto {BENCH_BASELINE} si existe)")
+    bench.add_argument("--save-baseline", action="store_true", help="escribir los resultados como línea base")
+    bench.add_argument("--threshold", type=float, default=None,
+                       help=f"razón de tiempo que cuenta como regresión (por defecto {BENCH_THRESHOLD})")
+    bench.set_defaults(func=cmd_bench)
+    return parser
+
+def cli(argv):
+    args = build_arg_parser().parse_args(argv)
+    if args.command is None:
+        return 0
+    return args.func(args)
+
 # --------------------------
 # Ejecutar app
 # --------------------------
-def main():
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        return cli(argv)
+    _load_gui()
     root = tk.Tk()
     root.geometry("1100x700")
     app = SAHAppV3(root)
     root.mainloop()
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,57 @@
+# calibrate() debe detenerse enseguida si el valor inicial ya ajusta y recuperar los
+# parámetros con que se generó el caudal observado.
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import SAH  # noqa: E402
+
+
+def _storm(a=20, p=300, seed=0):
+    rng = np.random.default_rng(seed)
+    areas = rng.uniform(0.1, 2.0, a)
+    P = np.where(rng.random(p) < 0.3, rng.gamma(0.6, 5.0, p), 0.0)
+    return areas, P, rng.uniform(0.2, 0.8, p), np.ones(p)
+
+
+@pytest.mark.parametrize("groups", ["global", "hourly", "events"])
+def test_starts_at_truth(groups):
+    areas, P, Ce, Cm = _storm()
+    if groups != "hourly":
+        Ce = np.full(P.size, 0.4)
+    _, flows = SAH.run_storm(areas, P, Ce, Cm)
+    g = SAH.rain_event_groups(P, 6) if groups == "events" else groups
+    res = SAH.calibrate(areas, P, flows, Ce=Ce, Cm=Cm, groups=g)
+    assert res.converged
+    assert res.iterations < 10
+    assert np.allclose(res.Ce, Ce)
+
+
+def test_starts_at_truth_cm():
+    areas, P, Ce, Cm = _storm()
+    _, flows = SAH.run_storm(areas, P, Ce, Cm)
+    res = SAH.calibrate(areas, P, flows, Ce=Ce, Cm=Cm, groups="global", fit="cm")
+    assert res.converged
+    assert res.iterations < 10
+    assert np.allclose(res.params, 1.0)
+
+
+def test_recovers_hourly_ce():
+    areas, P, Ce, Cm = _storm()
+    _, flows = SAH.run_storm(areas, P, Ce, Cm)
+    res = SAH.calibrate(areas, P, flows, Ce=np.full(P.size, 0.5), Cm=Cm, groups="hourly")
+    assert res.converged
+    wet = P > 0
+    assert np.abs(res.Ce[wet] - Ce[wet]).max() < 1e-2
+    assert res.rmse < 1e-3 * flows.max()
+
+
+def test_recovers_cm_factor():
+    areas, P, Ce, Cm = _storm()
+    _, flows = SAH.run_storm(areas, P, Ce, Cm * 1.3)
+    res = SAH.calibrate(areas, P, flows, Ce=Ce, Cm=Cm, groups="global", fit="cm")
+    assert res.converged
+    assert np.allclose(res.params, 1.3)
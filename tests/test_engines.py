@@ -0,0 +1,96 @@
+# Los motores de W (loop, direct, fft, auto) deben dar lo mismo que sumar las
+# antidiagonales de V, salvo redondeo.
+# compute_W_lagged con los retardos por defecto (0..a-1) debe coincidir exactamente con
+# compute_W, y con retardos fraccionarios debe conservar el volumen.
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import SAH  # noqa: E402
+
+
+def _fft_block(m):
+    # largo de bloque L que usa _W_fft con un núcleo de m muestras (cuando corta en bloques)
+    nfft = 8 * SAH._next_pow2(2 * m)
+    return nfft - m + 1
+
+
+def _inputs(a, p, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(1e4, 1e6, a), rng.gamma(0.6, 0.004, p)
+
+
+def _check(a, p):
+    A, q = _inputs(a, p, seed=a * 7919 + p)
+    ref = SAH.compute_W_from_V(np.outer(A, q))
+    assert ref.size == a + p - 1
+    for engine in SAH.W_ENGINES:
+        W = SAH.compute_W(A, q, engine=engine)
+        assert W.shape == ref.shape, engine
+        assert np.allclose(W, ref, rtol=1e-9, atol=1e-9 * np.abs(ref).max()), engine
+
+
+@pytest.mark.parametrize("a,p", [
+    (1, 1), (1, 50), (50, 1), (1, 5000), (5000, 1),
+    (3, 4), (4, 3),
+    (2000, 7), (1500, 150),   # a >> p (150 > W_DIRECT_MAX_KERNEL: auto usa fft)
+    (7, 2000), (150, 1500),   # p >> a
+])
+def test_engines_match_loop(a, p):
+    _check(a, p)
+
+
+@pytest.mark.parametrize("m", [2, 3, 17, 40])
+def test_fft_block_boundaries(m):
+    # largos justo antes, en y después de cada límite de bloque del overlap-add
+    # (núcleos cortos: bloques chicos y la referencia por bucle sigue siendo barata)
+    L = _fft_block(m)
+    for n in (L - 1, L, L + 1, 2 * L - 1, 2 * L, 2 * L + 1, 3 * L + m):
+        _check(n, m)
+        _check(m, n)
+
+
+def test_auto_picks_engine_by_size():
+    assert SAH.select_W_engine(5000, SAH.W_DIRECT_MAX_KERNEL) == "direct"
+    assert SAH.select_W_engine(5000, SAH.W_DIRECT_MAX_KERNEL + 1) == "fft"
+
+
+def test_unknown_engine_and_empty_inputs():
+    with pytest.raises(ValueError):
+        SAH.compute_W([1.0], [1.0], engine="gpu")
+    with pytest.raises(ValueError):
+        SAH.compute_W([], [1.0])
+
+
+@pytest.mark.parametrize("a,p", [(1, 1), (3, 4), (200, 7), (7, 200), (300, 300)])
+def test_default_lags_reproduce_compute_W(a, p):
+    # retardos 0..a-1: el núcleo es A tal cual y el resultado es idéntico, no sólo cercano
+    A, q = _inputs(a, p, seed=a + 31 * p)
+    assert np.array_equal(SAH.lag_kernel(A, SAH.default_lags(a)), A)
+    for engine in SAH.W_ENGINES:
+        assert np.array_equal(SAH.compute_W_lagged(A, q, SAH.default_lags(a), engine=engine),
+                              SAH.compute_W(A, q, engine=engine)), engine
+
+
+def test_fractional_lags_conserve_volume():
+    A, q = _inputs(50, 120, seed=5)
+    lags = np.random.default_rng(6).uniform(0.0, 80.0, A.size)
+    K = SAH.lag_kernel(A, lags)
+    assert np.isclose(K.sum(), A.sum())
+    assert K.size == int(np.ceil(lags.max())) + 1
+    for engine in SAH.W_ENGINES:
+        W = SAH.compute_W_lagged(A, q, lags, engine=engine)
+        assert W.size == K.size + q.size - 1
+        assert np.isclose(W.sum(), A.sum() * q.sum()), engine
+
+
+def test_lag_kernel_rejects_bad_lags():
+    with pytest.raises(ValueError):
+        SAH.lag_kernel([1.0, 2.0], [0.0])
+    with pytest.raises(ValueError):
+        SAH.lag_kernel([1.0], [-1.0])
+    with pytest.raises(ValueError):
+        SAH.lag_kernel([1.0], [np.nan])